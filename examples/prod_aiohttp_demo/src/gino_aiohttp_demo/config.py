@@ -23,3 +23,5 @@ DB_SSL = os.getenv("DB_SSL", "false").lower() in ("true", "yes", "1")
 DB_RETRY_LIMIT = int(os.getenv("DB_RETRY_LIMIT", 32))
 DB_RETRY_INTERVAL = int(os.getenv("DB_RETRY_INTERVAL", 1))
 DB_KWARGS = dict(map(lambda s: s.split("=", 1), os.getenv("DB_KWARGS", "").split()))
+
+APP_MODULES = frozenset(os.getenv("APP_MODULES", "").replace(",", " ").split())
@@ -1,3 +1,4 @@
+import functools
 import logging
 
 import click
@@ -37,8 +38,22 @@ def get_app():
     return app
 
 
-def load_modules(app=None):
-    for ep in entry_points()["gino_aiohttp_demo.modules"]:
+@functools.lru_cache(maxsize=None)
+def discover_modules(group="gino_aiohttp_demo.modules"):
+    try:
+        eps = entry_points(group=group)
+    except TypeError:  # pragma: no cover
+        # Python < 3.10 doesn't support selecting by group
+        eps = entry_points().get(group, ())
+    return tuple(eps)
+
+
+def load_modules(app=None, names=None):
+    if names is None:
+        names = config.APP_MODULES
+    for ep in discover_modules():
+        if names and ep.name not in names:
+            continue
         logger.info(
             "Loading module: %s",
             ep.name,
@@ -1,10 +1,727 @@
 import asyncio
+import collections
+import copy
+import functools
+import inspect
+import itertools
+import json
+import logging
+import re
+import sys
+import time
+import weakref
+from contextvars import ContextVar
 
-from aiohttp.web import HTTPNotFound, middleware
 from gino.api import Gino as _Gino, GinoExecutor as _Executor
 from gino.engine import GinoConnection as _Connection, GinoEngine as _Engine
+from gino.exceptions import GinoException
+from gino.loader import Loader, ModelLoader
 from gino.strategies import GinoStrategy
-from sqlalchemy.engine.url import URL
+from sqlalchemy.engine.url import URL, make_url
+
+logger = logging.getLogger(__name__)
+_query_stats = ContextVar("gino_aiohttp_query_stats", default=None)
+_search_path = ContextVar("gino_aiohttp_search_path", default=None)
+_identity_map = ContextVar("gino_aiohttp_identity_map", default=None)
+_tracer = ContextVar("gino_aiohttp_tracer", default=None)
+_watched_engine = ContextVar("gino_aiohttp_watched_engine", default=None)
+_drain_exempt = ContextVar("gino_aiohttp_drain_exempt", default=False)
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_spaces = re.compile(r"\s+")
+
+
+def _not_found(reason):
+    # aiohttp.web is imported on demand to keep ``import gino_aiohttp`` cheap
+    # for CLI tools and workers that never serve a request.
+    from aiohttp.web import HTTPNotFound
+
+    return HTTPNotFound(reason=reason)
+
+
+def _unavailable(reason):
+    from aiohttp.web import HTTPServiceUnavailable
+
+    return HTTPServiceUnavailable(reason=reason)
+
+
+class QueryBudgetExceeded(GinoException):
+    pass
+
+
+class DatabaseUnavailableError(GinoException):
+    pass
+
+
+class CircuitOpenError(DatabaseUnavailableError):
+    pass
+
+
+class EngineDrainingError(DatabaseUnavailableError):
+    pass
+
+
+class WriteBehindFull(GinoException):
+    pass
+
+
+def _is_disconnect(exc):
+    # Only meaningful for errors raised by the driver, see _Pool._acquire()
+    # and GinoEngine._observe_error()
+    if isinstance(exc, asyncio.TimeoutError):
+        # a statement timeout, also an OSError since Python 3.11
+        return False
+    if isinstance(exc, OSError):
+        return True
+    asyncpg = sys.modules.get("asyncpg")
+    return asyncpg is not None and isinstance(
+        exc, (asyncpg.PostgresConnectionError, asyncpg.CannotConnectNowError)
+    )
+
+
+def _is_read_only(exc):
+    # e.g. writing to a former primary after a failover
+    asyncpg = sys.modules.get("asyncpg")
+    return asyncpg is not None and isinstance(exc, asyncpg.ReadOnlySQLTransactionError)
+
+
+class CircuitBreaker:
+    """Fail fast when the database is unreachable.
+
+    After ``failure_threshold`` consecutive connection failures the circuit
+    opens, and acquiring connections raises :exc:`CircuitOpenError`
+    immediately. After ``recovery_timeout`` seconds, a single acquire is let
+    through as a probe: the circuit closes if it succeeds, or opens again if
+    not. Meanwhile, the pool is probed in the background at the same pace, so
+    that the circuit closes even without traffic.
+
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=5, recovery_timeout=5.0):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probed_at = 0.0
+        self._pool = None
+        self._task = None
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            since = self._opened_at
+        else:
+            # retry a half-open probe that never reported back
+            since = self._probed_at
+        if now - since < self.recovery_timeout:
+            return False
+        self.state = self.HALF_OPEN
+        self._probed_at = now
+        return True
+
+    def abort(self):
+        """Give up a probe that neither succeeded nor failed, e.g. cancelled."""
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+
+    def success(self):
+        self.failures = 0
+        if self.state != self.CLOSED:
+            logger.info("Database circuit closed")
+            self.state = self.CLOSED
+
+    def failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (
+            self.state == self.CLOSED and self.failures >= self.failure_threshold
+        ):
+            self._open()
+
+    def _open(self):
+        if self.state == self.CLOSED:
+            logger.warning("Database circuit opened after %d failures", self.failures)
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        if self._pool is not None and (self._task is None or self._task.done()):
+            self._task = asyncio.ensure_future(self._recover())
+
+    async def _recover(self):
+        pool = self._pool
+        expire = getattr(pool.raw_pool, "expire_connections", None)
+        if expire is not None:
+            # replace connections to the failed server on next acquire
+            await expire()
+        while self.state != self.CLOSED:
+            await asyncio.sleep(self.recovery_timeout)
+            if self.allow():
+                try:
+                    conn = await pool.acquire(timeout=self.recovery_timeout)
+                except Exception:
+                    self.failure()
+                else:
+                    await pool.release(conn)
+                    self.success()
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+class HostMonitor:
+    """Send new connections to the nearest writable database host.
+
+    :param hosts: a list of ``"host"``, ``"host:port"``, ``"[ipv6]:port"``
+      or ``(host, port)``, the port defaults to the one of the database URL.
+      Bare IPv6 addresses like ``"::1"`` take no port.
+    :param interval: seconds between health checks.
+    :param timeout: seconds to wait for each health check.
+    :param margin: how much slower than the nearest host the current one may
+      be before switching, as a fraction of the nearest latency. Differences
+      under a millisecond are always ignored.
+
+    Each host is checked in the background by connecting to it, measuring
+    the connect latency and querying ``pg_is_in_recovery()``. New pool
+    connections go to the writable host with the lowest latency, but stay on
+    the current host as long as it is writable and not slower by the
+    ``margin``. When the primary moves to another host, idle connections to
+    the former one are expired, and connection failures trigger a check at
+    once.
+
+    """
+
+    def __init__(self, hosts, interval=5.0, timeout=2.0, margin=0.5):
+        self.hosts = [_parse_host(host) for host in hosts]
+        self.interval = interval
+        self.timeout = timeout
+        self.margin = margin
+        self.latency = {}
+        self.writable = {}
+        self.current = None
+        self._connect_kwargs = None
+        self._pool = None
+        self._task = None
+        self._wakeup = None
+
+    def pool_class(self, pool_class):
+        async def factory(url, loop, **kwargs):
+            port = url.port or 5432
+            self.hosts = [(host, p or port) for host, p in self.hosts]
+            self._connect_kwargs = _connect_kwargs(url, kwargs)
+            del self._connect_kwargs["host"], self._connect_kwargs["port"]
+            self.current = await self.check()
+            if self.current is None:
+                logger.warning("No writable database host is found")
+                self.current = self.hosts[0]
+            url = copy.copy(url)
+            url.host, url.port = self.current
+            return await pool_class(url, loop, **kwargs)
+
+        return factory
+
+    def best(self):
+        """Return the writable ``(host, port)`` of the lowest latency, or the
+        current one if it is writable and not slower by the ``margin``."""
+        hosts = [host for host in self.hosts if self.writable.get(host)]
+        rv = min(hosts, key=self.latency.get, default=None)
+        current = self.current
+        if rv is not None and current != rv and self.writable.get(current):
+            # avoid bouncing between hosts of similar latency
+            nearest = self.latency[rv]
+            if self.latency[current] - nearest <= max(nearest * self.margin, 0.001):
+                return current
+        return rv
+
+    async def check(self):
+        """Check all hosts now and return the :meth:`best` one."""
+        await asyncio.gather(*(self._check(host) for host in self.hosts))
+        return self.best()
+
+    async def _check(self, host):
+        import asyncpg
+
+        start = time.monotonic()
+        try:
+            kwargs = dict(self._connect_kwargs, timeout=self.timeout)
+            conn = await asyncpg.connect(host=host[0], port=host[1], **kwargs)
+            try:
+                latency = time.monotonic() - start
+                recovery = await conn.fetchval(
+                    "SELECT pg_is_in_recovery()", timeout=self.timeout
+                )
+            finally:
+                await conn.close()
+        except Exception as e:
+            if self.latency.get(host, 0) is not None:
+                logger.warning("Database host %s:%s is unavailable: %r", *host, e)
+            self.latency[host] = None
+            self.writable[host] = False
+        else:
+            self.latency[host] = latency
+            self.writable[host] = not recovery
+
+    def wake(self):
+        """Check all hosts without waiting for the next interval."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _start(self, pool):
+        self._pool = pool
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self._update()
+            except Exception:
+                logger.exception("Failed to update the database host")
+
+    async def _update(self):
+        previous = self.current
+        best = await self.check()
+        if best is None or best == previous:
+            return
+        self.current = best
+        raw_pool = self._pool.raw_pool
+        raw_pool.set_connect_args(host=best[0], port=best[1], **self._connect_kwargs)
+        if self.writable.get(previous):
+            logger.info("Switched to nearer database host %s:%s", *best)
+        else:
+            logger.warning(
+                "Database primary moved from %s:%s to %s:%s", *previous, *best
+            )
+            await raw_pool.expire_connections()
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+def _connect_kwargs(url, kwargs):
+    # Arguments of asyncpg.connect() out of those of a GINO asyncpg pool
+    import asyncpg
+
+    rv = dict(
+        host=url.host,
+        port=url.port,
+        user=url.username,
+        password=url.password,
+        database=url.database,
+    )
+    for k in inspect.getfullargspec(asyncpg.connect).kwonlyargs:
+        if k in kwargs and k not in rv and k != "loop":
+            rv[k] = kwargs[k]
+    return rv
+
+
+def _parse_host(host):
+    if isinstance(host, str):
+        if host.startswith("["):
+            host, _, port = host[1:].partition("]")
+            return host, int(port[1:]) if port else None
+        if host.count(":") == 1:
+            host, port = host.split(":")
+            return host, int(port)
+        # a host name, or a bare IPv6 address
+        return host, None
+    host, port = host
+    return host, port
+
+
+class _Pool:
+    # Wraps the dialect pool to track borrowed connections.
+
+    def __init__(self, pool, breaker=None, monitor=None):
+        self._pool = pool
+        self._breaker = breaker
+        self._monitor = monitor
+        self._drained = None
+        self.borrowed = set()
+        self.draining = False
+        if breaker is not None:
+            breaker._pool = pool
+        if monitor is not None:
+            monitor._start(pool)
+
+    @property
+    def raw_pool(self):
+        return self._pool.raw_pool
+
+    async def acquire(self, *, timeout=None):
+        tracer = _tracer.get()
+        if tracer is None:
+            return await self._acquire(timeout)
+        with tracer.start_as_current_span("gino.acquire"):
+            return await self._acquire(timeout)
+
+    async def _acquire(self, timeout):
+        if self.draining and not _drain_exempt.get():
+            raise EngineDrainingError("Database is shutting down")
+        breaker = self._breaker
+        if breaker is None and self._monitor is None:
+            rv = await self._pool.acquire(timeout=timeout)
+        else:
+            if breaker is not None and not breaker.allow():
+                raise CircuitOpenError("Database is unavailable")
+            try:
+                rv = await self._pool.acquire(timeout=timeout)
+            except BaseException as e:
+                if self._is_connect_failure(e):
+                    if breaker is not None:
+                        breaker.failure()
+                    if self._monitor is not None:
+                        self._monitor.wake()
+                elif breaker is not None:
+                    breaker.abort()
+                raise
+            if breaker is not None:
+                breaker.success()
+        self.borrowed.add(rv)
+        return rv
+
+    def _is_connect_failure(self, exc):
+        if isinstance(exc, asyncio.TimeoutError):
+            # a timeout waiting for a free connection is not a failure
+            get_max_size = getattr(self.raw_pool, "get_max_size", None)
+            return get_max_size is None or len(self.borrowed) < get_max_size()
+        return isinstance(exc, Exception) and _is_disconnect(exc)
+
+    async def release(self, conn):
+        tracer = _tracer.get()
+        if tracer is None:
+            return await self._release(conn)
+        with tracer.start_as_current_span("gino.release"):
+            return await self._release(conn)
+
+    async def _release(self, conn):
+        self.borrowed.discard(conn)
+        try:
+            return await self._pool.release(conn)
+        finally:
+            if not self.borrowed and self._drained is not None:
+                self._drained.set()
+
+    async def _wait_released(self, timeout):
+        if self.borrowed:
+            try:
+                await asyncio.wait_for(self._drained.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _connect(self):
+        # A dedicated connection, the stragglers may hold all of the pool
+        connect = getattr(self._pool, "connect", None)
+        if connect is not None:
+            return await connect()
+        import asyncpg
+
+        # noinspection PyProtectedMember,PyUnresolvedReferences
+        kwargs = _connect_kwargs(self._pool._url, self._pool._kwargs)
+        if self._monitor is not None:
+            kwargs["host"], kwargs["port"] = self._monitor.current
+        kwargs["timeout"] = 1
+        return await asyncpg.connect(**kwargs)
+
+    async def _cancel(self, conns):
+        pids = [conn.get_server_pid() for conn in conns]
+        try:
+            conn = await self._connect()
+        except Exception:
+            logger.warning("Cannot connect to cancel %d backends", len(pids))
+            return 0
+        rv = 0
+        try:
+            for pid in pids:
+                if await conn.fetchval("SELECT pg_cancel_backend($1)", pid):
+                    rv += 1
+        finally:
+            await conn.close()
+        return rv
+
+    async def shutdown(self, timeout):
+        if self.draining:
+            return dict(released=0, cancelled=0, terminated=0)
+        self.draining = True
+        self._drained = asyncio.Event()
+        borrowed = len(self.borrowed)
+        await self._wait_released(timeout)
+        stragglers = len(self.borrowed)
+        cancelled = 0
+        if stragglers:
+            cancelled = await self._cancel(list(self.borrowed))
+            await self._wait_released(1)
+        terminated = len(self.borrowed)
+        if terminated:
+            self._pool.raw_pool.terminate()
+        return dict(
+            released=borrowed - stragglers,
+            cancelled=cancelled,
+            terminated=terminated,
+        )
+
+    async def close(self):
+        if self._breaker is not None:
+            self._breaker.close()
+        if self._monitor is not None:
+            self._monitor.close()
+        return await self._pool.close()
+
+    def repr(self, color):
+        return self._pool.repr(color)
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(statement):
+    """Normalize SQL by replacing literals and collapsing whitespaces."""
+    return _spaces.sub(" ", _literals.sub("?", statement)).strip()
+
+
+class QueryStats:
+    """Statements executed during one request, at ``request['query_stats']``."""
+
+    __slots__ = ("statements", "duration", "fingerprints")
+
+    def __init__(self):
+        self.statements = 0
+        self.duration = 0.0
+        self.fingerprints = collections.Counter()
+
+    def record(self, statement, duration):
+        self.statements += 1
+        self.duration += duration
+        self.fingerprints[fingerprint(statement)] += 1
+
+    def repeated(self, limit):
+        """Return ``(fingerprint, count)`` of statements run over ``limit`` times."""
+        return [(fp, n) for fp, n in self.fingerprints.items() if n > limit]
+
+
+class _ObservedResult:
+    __slots__ = ("_result", "_stats", "_tracer", "_engine")
+
+    def __init__(self, result, stats, tracer=None, engine=None):
+        self._result = result
+        self._stats = stats
+        self._tracer = tracer
+        self._engine = engine
+
+    @property
+    def context(self):
+        return self._result.context
+
+    async def execute(self, *args, **kwargs):
+        return await self._observe(self._result.execute(*args, **kwargs))
+
+    def iterate(self):
+        if self._stats is None and self._tracer is None:
+            return self._result.iterate()
+        return self._cursor(self._result.iterate())
+
+    def _cursor(self, cursor):
+        if self._stats is not None:
+            self._stats.record(self._result.context.statement, 0.0)
+        return _ObservedCursor(cursor, self)
+
+    async def prepare(self, clause):
+        return _ObservedPrepared(await self._result.prepare(clause), self)
+
+    async def records(self):
+        return await self._observe(_records(self._result))
+
+    async def _observe(self, coro, row_count=True):
+        if self._engine is not None:
+            try:
+                return await self._trace(coro, row_count)
+            except Exception as e:
+                self._engine._observe_error(e)
+                raise
+        return await self._trace(coro, row_count)
+
+    async def _trace(self, coro, row_count=True):
+        if self._tracer is None:
+            return await self._measure(coro)
+        with self._span() as span:
+            rv = await self._measure(coro)
+            count = _row_count(self._result.context) if row_count else None
+            if count is not None:
+                span.set_attribute("db.row_count", count)
+            return rv
+
+    def _span(self):
+        return self._tracer.start_as_current_span(
+            "gino.query",
+            attributes={
+                "db.system": "postgresql",
+                "db.statement": fingerprint(self._result.context.statement),
+            },
+        )
+
+    async def _measure(self, coro):
+        if self._stats is None:
+            return await coro
+        start = time.monotonic()
+        try:
+            return await coro
+        finally:
+            self._stats.record(self._result.context.statement, time.monotonic() - start)
+
+    async def _fetch(self, awaitable, first=False):
+        # a fetch of a cursor, the first one executes the statement and is
+        # traced, the time of all is added to the statement recorded before
+        if first and self._tracer is not None:
+            with self._span():
+                return await self._time(awaitable)
+        return await self._time(awaitable)
+
+    async def _time(self, awaitable):
+        if self._stats is None:
+            return await awaitable
+        start = time.monotonic()
+        try:
+            return await awaitable
+        finally:
+            self._stats.duration += time.monotonic() - start
+
+
+class _ObservedCursor:
+    # The cursor of iterate(), either iterated or awaited for fetches
+    __slots__ = ("_cursor", "_observer", "_started")
+
+    def __init__(self, cursor, observer):
+        self._cursor = cursor
+        self._observer = observer
+        self._started = False
+
+    def _fetch(self, awaitable):
+        first, self._started = not self._started, True
+        return self._observer._fetch(awaitable, first)
+
+    def __aiter__(self):
+        self._cursor = self._cursor.__aiter__()
+        return self
+
+    async def __anext__(self):
+        return await self._fetch(self._cursor.__anext__())
+
+    def __await__(self):
+        return self._open().__await__()
+
+    async def _open(self):
+        self._cursor = await self._fetch(self._cursor)
+        return self
+
+    async def many(self, n, **kwargs):
+        return await self._fetch(self._cursor.many(n, **kwargs))
+
+    async def next(self, **kwargs):
+        return await self._fetch(self._cursor.next(**kwargs))
+
+    async def forward(self, n, **kwargs):
+        return await self._fetch(self._cursor.forward(n, **kwargs))
+
+
+class _ObservedPrepared:
+    # Each execution of a prepared statement is observed as a statement
+    __slots__ = ("_prepared", "_observer")
+
+    def __init__(self, prepared, observer):
+        self._prepared = prepared
+        self._observer = observer
+
+    def __getattr__(self, item):
+        return getattr(self._prepared, item)
+
+    def iterate(self, *params, **kwargs):
+        return self._observer._cursor(self._prepared.iterate(*params, **kwargs))
+
+    async def all(self, *multiparams, **params):
+        return await self._observe(self._prepared.all(*multiparams, **params))
+
+    async def first(self, *multiparams, **params):
+        return await self._observe(self._prepared.first(*multiparams, **params))
+
+    async def scalar(self, *multiparams, **params):
+        return await self._observe(self._prepared.scalar(*multiparams, **params))
+
+    async def status(self, *multiparams, **params):
+        return await self._observe(self._prepared.status(*multiparams, **params))
+
+    def _observe(self, coro):
+        return self._observer._observe(coro, row_count=False)
+
+
+def _row_count(context):
+    try:
+        status = context.cursor.get_statusmsg()
+    except Exception:
+        return None
+    count = status.rsplit(" ", 1)[-1]
+    return int(count) if count.isdigit() else None
+
+
+async def _records(result):
+    # Like _ResultProxy.execute() but skips SQLAlchemy and GINO row processing
+    context = result.context
+    if context.executemany:
+        raise ValueError("too many multiparams")
+    args = []
+    for val in context.parameters[0]:
+        if asyncio.iscoroutine(val):
+            val = await val
+        args.append(val)
+    return await context.cursor.async_execute(context.statement, context.timeout, args)
+
+
+def _json_default(obj):
+    if hasattr(obj, "keys"):
+        return dict(obj)
+    raise TypeError(
+        "Object of type {} is not JSON serializable".format(type(obj).__name__)
+    )
+
+
+def json_dumps(obj, **kwargs):
+    """JSON encoder that also accepts records from :meth:`GinoExecutor.rows`.
+
+    Use it as ``dumps`` of ``aiohttp.web.json_response``::
+
+        return web.json_response(await User.query.gino.rows(), dumps=json_dumps)
+
+    """
+    kwargs.setdefault("default", _json_default)
+    return json.dumps(obj, **kwargs)
+
+
+def query_budget(*, statements=None, duration=None, repeats=None):
+    """Declare the database budget of an aiohttp handler.
+
+    :param statements: the maximum number of statements per request.
+    :param duration: the maximum total database time per request in seconds.
+    :param repeats: the maximum number of runs of the same statement
+      fingerprint per request, usually caused by N+1 query patterns.
+
+    """
+
+    def decorator(handler):
+        handler.__gino_budget__ = dict(
+            statements=statements, duration=duration, repeats=repeats
+        )
+        return handler
+
+    return decorator
 
 
 class AiohttpModelMixin:
@@ -13,25 +730,121 @@ class AiohttpModelMixin:
         # noinspection PyUnresolvedReferences
         rv = await cls.get(*args, **kwargs)
         if rv is None:
-            raise HTTPNotFound(reason="{} is not found".format(cls.__name__))
+            raise _not_found("{} is not found".format(cls.__name__))
+        return rv
+
+    @classmethod
+    async def create_later(cls, **values):
+        """Insert a row in the background, see :meth:`Gino.defer_insert`.
+
+        Unlike ``create()``, nothing is returned and JSON properties are not
+        supported.
+
+        """
+        # noinspection PyArgumentList
+        obj = cls(**values)
+        # noinspection PyUnresolvedReferences,PyProtectedMember
+        await cls.__metadata__.defer_insert(
+            cls.__table__, obj._get_sa_values(obj.__values__)
+        )
+
+
+class _IdentityModelLoader(ModelLoader):
+    # Looks up the request's identity map before creating an instance, only
+    # for rows of all the columns, partially loaded instances are not shared
+    def _do_load(self, row):
+        identity_map = _identity_map.get()
+        if (
+            identity_map is None
+            or self.columns is not self.model
+            or not self.model.__table__.primary_key.columns
+            or not all(c in row for c in self.model)
+        ):
+            return super()._do_load(row)
+        pk = self.model.__table__.primary_key.columns
+        key = (self.model, tuple(row[c] for c in pk))
+        rv = identity_map.get(key)
+        if rv is None:
+            rv = super()._do_load(row)
+            if rv is not None:
+                identity_map[key] = rv
         return rv
 
 
+def _identity_loader(loader):
+    if type(loader) is not ModelLoader or not hasattr(loader.model, "__table__"):
+        return loader
+    rv = _IdentityModelLoader.__new__(_IdentityModelLoader)
+    rv.__dict__.update(loader.__dict__)
+    rv.extras = {key: _identity_loader(value) for key, value in loader.extras.items()}
+    return rv
+
+
+def _with_identity_map(clause):
+    get_options = getattr(clause, "get_execution_options", None)
+    if get_options is None:
+        return clause
+    options = get_options()
+    loader = options.get("loader")
+    if loader is None:
+        model = options.get("model")
+        if isinstance(model, weakref.ref):
+            model = model()
+        if model is None:
+            return clause
+        loader = model
+    loader = _identity_loader(Loader.get(loader))
+    if not isinstance(loader, _IdentityModelLoader):
+        return clause
+    return clause.execution_options(loader=loader)
+
+
 # noinspection PyClassHasNoInit
 class GinoExecutor(_Executor):
     async def first_or_404(self, *args, **kwargs):
         rv = await self.first(*args, **kwargs)
         if rv is None:
-            raise HTTPNotFound(reason="No such data")
+            raise _not_found("No such data")
         return rv
 
+    async def rows(self, *multiparams, **params):
+        """Returns raw database records, see :meth:`GinoConnection.rows`."""
+        return await self._query.bind.rows(self._query, *multiparams, **params)
+
 
 # noinspection PyClassHasNoInit
 class GinoConnection(_Connection):
+    def _execute(self, clause, multiparams, params):
+        if _identity_map.get() is not None:
+            clause = _with_identity_map(clause)
+        rv = super()._execute(clause, multiparams, params)
+        stats = _query_stats.get()
+        tracer = _tracer.get()
+        engine = _watched_engine.get()
+        if stats is not None or tracer is not None or engine is not None:
+            rv = _ObservedResult(rv, stats, tracer, engine)
+        return rv
+
+    async def rows(self, clause, *multiparams, **params):
+        """
+        Runs the given query in database, returns all results as a list of
+        raw database records, e.g. :class:`asyncpg.Record`.
+
+        Records are accessed by column names or indexes, without creating
+        model instances or SQLAlchemy row proxies, so this is much cheaper
+        than :meth:`all` for large read-only results. Use :data:`json_dumps`
+        to encode them in JSON responses.
+
+        """
+        result = self._execute(clause, multiparams, params)
+        if isinstance(result, _ObservedResult):
+            return await result.records()
+        return await _records(result)
+
     async def first_or_404(self, *args, **kwargs):
         rv = await self.first(*args, **kwargs)
         if rv is None:
-            raise HTTPNotFound(reason="No such data")
+            raise _not_found("No such data")
         return rv
 
 
@@ -39,12 +852,558 @@ class GinoConnection(_Connection):
 class GinoEngine(_Engine):
     connection_cls = GinoConnection
 
+    def __init__(
+        self,
+        dialect,
+        pool,
+        loop,
+        logging_name=None,
+        echo=None,
+        execution_options=None,
+        circuit_breaker=None,
+        host_monitor=None,
+    ):
+        super().__init__(
+            dialect,
+            _Pool(pool, circuit_breaker, host_monitor),
+            loop,
+            logging_name=logging_name,
+            echo=echo,
+            execution_options=execution_options,
+        )
+        self.circuit_breaker = circuit_breaker
+        self.host_monitor = host_monitor
+
+    def _observe_error(self, exc):
+        # Called with errors of statements executed in middleware requests
+        if _is_disconnect(exc):
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.failure()
+            if self.host_monitor is not None:
+                self.host_monitor.wake()
+        elif self.host_monitor is not None and _is_read_only(exc):
+            self.host_monitor.wake()
+
+    async def shutdown(self, timeout=10):
+        """Stop admitting new database work, without closing the pool.
+
+        New connections are refused with :exc:`EngineDrainingError` at once,
+        then borrowed connections are waited for at most ``timeout`` seconds
+        to be released. Queries still running after that are cancelled with
+        ``pg_cancel_backend`` over a dedicated connection, and whatever
+        remains is terminated. Only the first call does so.
+
+        :return: a dictionary of the numbers of connections ``released``,
+          ``cancelled`` and ``terminated``.
+
+        """
+        rv = await self._pool.shutdown(timeout)
+        logger.info(
+            "Drained database pool: %(released)d released, %(cancelled)d "
+            "cancelled, %(terminated)d terminated",
+            rv,
+        )
+        return rv
+
+    async def drain(self, timeout=10):
+        """Gracefully close this engine, see :meth:`shutdown`."""
+        rv = await self.shutdown(timeout)
+        await self.close()
+        return rv
+
+    async def first_or_404(self, *args, **kwargs):
+        rv = await self.first(*args, **kwargs)
+        if rv is None:
+            raise _not_found("No such data")
+        return rv
+
+    async def rows(self, clause, *multiparams, **params):
+        async with self.acquire(reuse=True) as conn:
+            return await conn.rows(clause, *multiparams, **params)
+
+
+class ScopedConnection:
+    """Stand-in for ``request['connection']`` in long-lived handlers.
+
+    It never holds a database connection by itself: each query borrows one
+    from the pool and returns it right after, while :meth:`acquire` or
+    :meth:`transaction` keep a connection only for the given unit of work::
+
+        async with request['connection'].transaction():
+            await User.create(nickname='fantix')
+            await Log.create(message='new user')
+
+    """
+
+    __slots__ = ("_db",)
+
+    def __init__(self, db):
+        self._db = db
+
+    def acquire(self, *args, **kwargs):
+        return self._db.acquire(*args, **kwargs)
+
+    def transaction(self, *args, **kwargs):
+        return self._db.transaction(*args, **kwargs)
+
+    def iterate(self, clause, *multiparams, **params):
+        return self._db.iterate(clause, *multiparams, **params)
+
+    async def all(self, clause, *multiparams, **params):
+        return await self._db.all(clause, *multiparams, **params)
+
+    async def first(self, clause, *multiparams, **params):
+        return await self._db.first(clause, *multiparams, **params)
+
+    async def one_or_none(self, clause, *multiparams, **params):
+        return await self._db.one_or_none(clause, *multiparams, **params)
+
+    async def one(self, clause, *multiparams, **params):
+        return await self._db.one(clause, *multiparams, **params)
+
+    async def scalar(self, clause, *multiparams, **params):
+        return await self._db.scalar(clause, *multiparams, **params)
+
+    async def status(self, clause, *multiparams, **params):
+        return await self._db.status(clause, *multiparams, **params)
+
+    async def rows(self, clause, *multiparams, **params):
+        return await self._db.rows(clause, *multiparams, **params)
+
     async def first_or_404(self, *args, **kwargs):
         rv = await self.first(*args, **kwargs)
         if rv is None:
-            raise HTTPNotFound(reason="No such data")
+            raise _not_found("No such data")
         return rv
 
+    async def release(self, *, permanent=True):
+        """Nothing to release, connections are returned after each use."""
+
+
+def scoped_connection(handler):
+    """Mark an aiohttp handler to run with a :class:`ScopedConnection`.
+
+    Use this on long-lived handlers like websockets or server-sent events, so
+    that idle time in the handler doesn't hold a pooled connection::
+
+        @routes.get('/ws')
+        @scoped_connection
+        async def ws_handler(request):
+            ...
+
+    """
+    handler.__gino_scoped__ = True
+    return handler
+
+
+class _ConnectionHooks:
+    # Installed as ``init`` and ``setup`` of asyncpg pools of one engine.
+
+    def __init__(self, db, setup=None):
+        self._db = db
+        self._setup = setup
+        self._init = None
+        # raw connection -> number of on_connect hooks applied to it, dropped
+        # together with the connection
+        self._applied = weakref.WeakKeyDictionary()
+
+    def pool_class(self, pool_class=None):
+        def factory(url, loop, init=None, **kwargs):
+            cls = pool_class
+            if cls is None:
+                from gino.dialects.asyncpg import Pool as cls
+            self._init = init
+            return cls(url, loop, init=self.init, **kwargs)
+
+        return factory
+
+    async def init(self, conn):
+        if self._init is not None:
+            await self._init(conn)
+        hooks = self._db.connect_hooks
+        for hook in hooks:
+            await hook(conn)
+        self._applied[conn] = len(hooks)
+
+    async def setup(self, conn):
+        hooks = self._db.connect_hooks
+        if hooks:
+            # asyncpg passes a PoolConnectionProxy here, not the connection
+            # noinspection PyProtectedMember
+            raw_conn = getattr(conn, "_con", conn)
+            applied = self._applied.get(raw_conn, 0)
+            if applied < len(hooks):
+                # hooks registered after this connection was created
+                for hook in hooks[applied:]:
+                    await hook(conn)
+                self._applied[raw_conn] = len(hooks)
+        search_path = _search_path.get()
+        if search_path is not None:
+            # asyncpg does RESET ALL on release, no need to restore it
+            await conn.execute("SET search_path TO " + search_path)
+        for hook in self._db.acquire_hooks:
+            await hook(conn)
+        if self._setup is not None:
+            await self._setup(conn)
+
+
+def _otel_extract():
+    try:
+        from opentelemetry.propagate import extract
+    except ImportError:
+        return None
+    return extract
+
+
+async def _maybe_await(rv):
+    if inspect.isawaitable(rv):
+        rv = await rv
+    return rv
+
+
+class _Tenant:
+    __slots__ = ("engine", "search_path", "in_use", "last_used")
+
+    def __init__(self, engine, search_path):
+        self.engine = engine
+        self.search_path = search_path
+        self.in_use = 0
+        self.last_used = time.monotonic()
+
+
+class TenantRouter:
+    """Route requests to tenant databases or schemas.
+
+    :param resolver: a callable taking the request and returning a hashable
+      tenant key, or ``None`` to use the default bind.
+    :param config: a callable taking a tenant key and returning a dictionary
+      with optional keys ``dsn``, ``search_path``, ``pool_min_size``,
+      ``pool_max_size`` and ``kwargs``. Tenants without ``dsn`` share the
+      default bind, while ``search_path`` - a schema name or a list of them -
+      is set on each connection borrowed for the tenant.
+    :param max_engines: the maximum number of idle tenants to keep.
+    :param idle_timeout: seconds before an idle tenant engine is closed.
+    :param sweep_interval: seconds between checks for idle tenants once
+      :meth:`start` is called.
+    :param write_behind: the :class:`WriteBehind` buffer that may hold
+      deferred writes of tenant engines, flushed before closing them.
+
+    Both callables may also be coroutine functions. Tenant engines are created
+    on first use and kept in a LRU, idle ones are evicted on the next request
+    or sweep and closed in the background.
+
+    """
+
+    def __init__(
+        self,
+        resolver,
+        config,
+        *,
+        max_engines=32,
+        idle_timeout=300,
+        pool_min_size=0,
+        pool_max_size=5,
+        sweep_interval=60,
+        write_behind=None,
+    ):
+        self._resolver = resolver
+        self._config = config
+        self.max_engines = max_engines
+        self.idle_timeout = idle_timeout
+        self.pool_min_size = pool_min_size
+        self.pool_max_size = pool_max_size
+        self.sweep_interval = sweep_interval
+        self.write_behind = write_behind
+        self._tenants = collections.OrderedDict()
+        self._locks = {}
+        self._waiting = collections.Counter()
+        self._closing = set()
+        self._task = None
+
+    def __len__(self):
+        return len(self._tenants)
+
+    def __contains__(self, key):
+        return key in self._tenants
+
+    async def resolve(self, request):
+        return await _maybe_await(self._resolver(request))
+
+    async def enter(self, db, key):
+        tenant = self._tenants.get(key)
+        if tenant is None:
+            # the lock is shared until no one waits on it, so that an engine is
+            # created once even when the first attempt failed
+            self._waiting[key] += 1
+            try:
+                async with self._locks.setdefault(key, asyncio.Lock()):
+                    tenant = self._tenants.get(key)
+                    if tenant is None:
+                        created = await self._create(db, key)
+                        tenant = self._tenants.setdefault(key, created)
+                        if tenant is not created and created.engine is not None:
+                            await created.engine.close()
+            finally:
+                self._waiting[key] -= 1
+                if not self._waiting[key]:
+                    del self._waiting[key]
+                    del self._locks[key]
+        self._tenants.move_to_end(key)
+        tenant.in_use += 1
+        tenant.last_used = time.monotonic()
+        self._evict()
+        return tenant
+
+    def leave(self, tenant):
+        tenant.in_use -= 1
+        tenant.last_used = time.monotonic()
+
+    async def _create(self, db, key):
+        config = await _maybe_await(self._config(key))
+        search_path = config.get("search_path")
+        if search_path is not None:
+            if isinstance(search_path, str):
+                search_path = [search_path]
+            search_path = ", ".join(
+                '"{}"'.format(name.replace('"', '""')) for name in search_path
+            )
+        engine = None
+        if "dsn" in config:
+            from gino import create_engine
+
+            kwargs = dict(config.get("kwargs", {}))
+            kwargs.setdefault("strategy", AiohttpStrategy.name)
+            db._install_hooks(kwargs)
+            engine = await create_engine(
+                config["dsn"],
+                min_size=config.get("pool_min_size", self.pool_min_size),
+                max_size=config.get("pool_max_size", self.pool_max_size),
+                **kwargs,
+            )
+        return _Tenant(engine, search_path)
+
+    def _evict(self):
+        now = time.monotonic()
+        over = len(self._tenants) - self.max_engines
+        for key, tenant in list(self._tenants.items()):
+            if tenant.in_use:
+                continue
+            if over > 0 or now - tenant.last_used > self.idle_timeout:
+                over -= 1
+                del self._tenants[key]
+                if tenant.engine is not None:
+                    # don't hold up the request that triggered the eviction
+                    task = asyncio.ensure_future(self._close_engine(tenant.engine))
+                    self._closing.add(task)
+                    task.add_done_callback(self._closing.discard)
+
+    async def _close_engine(self, engine):
+        try:
+            if self.write_behind is not None and self.write_behind.holds(engine):
+                # the writes deferred by the last requests of the tenant
+                await self.write_behind.flush()
+            await engine.close()
+        except Exception:
+            logger.exception("Failed to close an evicted tenant engine")
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            self._evict()
+
+    async def shutdown(self, timeout):
+        """Stop admitting new work to all tenant engines, see
+        :meth:`GinoEngine.shutdown`."""
+        await asyncio.gather(
+            *(
+                tenant.engine.shutdown(timeout)
+                for tenant in self._tenants.values()
+                if tenant.engine is not None
+            )
+        )
+
+    async def close(self, drain_timeout=None):
+        task, self._task = self._task, None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        tenants, self._tenants = self._tenants, collections.OrderedDict()
+        for tenant in tenants.values():
+            if tenant.engine is None:
+                pass
+            elif drain_timeout is None:
+                await tenant.engine.close()
+            else:
+                await tenant.engine.drain(drain_timeout)
+        if self._closing:
+            await asyncio.gather(*self._closing)
+
+
+class WriteBehind:
+    """A bounded buffer of writes flushed in batches by a background task.
+
+    :param max_size: the maximum number of buffered writes.
+    :param batch_size: flush at once when this number of writes is buffered.
+    :param flush_interval: seconds to wait for more writes before flushing.
+    :param policy: what to do when the buffer is full - ``"block"`` until it
+      is flushed (default), ``"drop"`` the new write with a warning, or
+      ``"raise"`` :exc:`WriteBehindFull`.
+
+    Each flush uses its own connection and transaction per bind and tenant
+    ``search_path``. Consecutive inserts into the same table with the same
+    columns are sent as one multi-row ``INSERT``, other statements are
+    executed in order. If such a transaction fails, its writes are retried
+    one at a time, so that a bad write only loses itself.
+
+    """
+
+    def __init__(
+        self, max_size=10000, batch_size=500, flush_interval=1.0, policy="block"
+    ):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.dropped = 0
+        self._buffer = collections.deque()
+        self._pending = None
+        self._full = None
+        self._space = None
+        self._lock = None
+        self._task = None
+        self._flushing = set()
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def holds(self, bind):
+        """Return ``True`` if writes to ``bind`` are buffered or being flushed."""
+        return bind in self._flushing or any(item[0] is bind for item in self._buffer)
+
+    @property
+    def started(self):
+        return self._task is not None
+
+    def start(self):
+        self._pending = asyncio.Event()
+        self._full = asyncio.Event()
+        self._space = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        task, self._task = self._task, None
+        if task is not None:
+            # don't interrupt an ongoing flush
+            async with self._lock:
+                task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+    async def put(self, bind, table, payload):
+        while len(self._buffer) >= self.max_size:
+            if self.policy == "drop":
+                self.dropped += 1
+                logger.warning("Write-behind buffer is full, dropping a write")
+                return False
+            if self.policy == "raise":
+                raise WriteBehindFull("Write-behind buffer is full")
+            self._full.set()
+            self._space.clear()
+            await self._space.wait()
+        self._buffer.append((bind, _search_path.get(), table, payload))
+        self._pending.set()
+        if len(self._buffer) >= self.batch_size:
+            self._full.set()
+        return True
+
+    async def _run(self):
+        while True:
+            await self._pending.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self):
+        if self._lock is None:
+            return
+        # deferred writes are still flushed after the engine stopped
+        # admitting new work on shutdown
+        token = _drain_exempt.set(True)
+        try:
+            await self._flush()
+        finally:
+            _drain_exempt.reset(token)
+
+    async def _flush(self):
+        async with self._lock:
+            while self._buffer:
+                n = min(self.batch_size, len(self._buffer))
+                batch = [self._buffer.popleft() for _ in range(n)]
+                self._space.set()
+                self._flushing = {item[0] for item in batch}
+                try:
+                    await self._write(batch)
+                finally:
+                    self._flushing = set()
+            self._pending.clear()
+            self._full.clear()
+
+    @staticmethod
+    def _group_key(item):
+        bind, search_path, table, payload = item
+        if table is None:
+            return bind, search_path, None, id(payload)
+        return bind, search_path, table, tuple(sorted(payload))
+
+    async def _write(self, batch):
+        for (bind, search_path), items in itertools.groupby(
+            batch, key=lambda item: item[:2]
+        ):
+            items = list(items)
+            try:
+                await self._write_group(bind, search_path, items)
+            except Exception:
+                if len(items) == 1:
+                    logger.exception("Failed to flush a deferred write")
+                    continue
+                logger.warning(
+                    "Failed to flush %d deferred writes, retrying one by one",
+                    len(items),
+                    exc_info=True,
+                )
+                for item in items:
+                    try:
+                        await self._write_group(bind, search_path, [item])
+                    except Exception:
+                        logger.exception("Failed to flush a deferred write")
+
+    async def _write_group(self, bind, search_path, items):
+        async with bind.transaction() as tx:
+            conn = tx.connection
+            if search_path is not None:
+                # the tenant schemas of the request that deferred the writes
+                await conn.status("SET LOCAL search_path TO " + search_path)
+            groups = itertools.groupby(items, key=self._group_key)
+            for (_, _, table, _), group in groups:
+                if table is None:
+                    for _, _, _, (clause, multiparams, params) in group:
+                        await conn.status(clause, *multiparams, **params)
+                else:
+                    rows = [payload for _, _, _, payload in group]
+                    await conn.status(table.insert().values(rows))
+
 
 class AiohttpStrategy(GinoStrategy):
     name = "aiohttp"
@@ -54,7 +1413,29 @@ class AiohttpStrategy(GinoStrategy):
 AiohttpStrategy()
 
 
-@middleware
+class FakeStrategy(AiohttpStrategy):
+    """Create a :class:`GinoEngine` on a :class:`gino_aiohttp_fake.FakePool`
+    for unit tests and benchmarks without a database, e.g.::
+
+        db.set_bind("fake://", strategy="aiohttp_fake", latency=0.001)
+
+    Also by setting ``"strategy": "aiohttp_fake"`` in the config. The
+    :mod:`gino_aiohttp_fake` module is only imported when this is used.
+
+    """
+
+    name = "aiohttp_fake"
+
+    async def create(self, name_or_url, loop=None, **kwargs):
+        from gino_aiohttp_fake import FakeURL
+
+        u = FakeURL.from_url(make_url(name_or_url))
+        return await super().create(u, loop, **kwargs)
+
+
+FakeStrategy()
+
+
 class Gino(_Gino):
     """Support aiohttp.web server.
 
@@ -84,12 +1465,79 @@ class Gino(_Gino):
     * ``database`` - database name, default is ``postgres``.
     * ``dsn`` - a SQLAlchemy database URL to create the engine, its existence
       will replace all previous connect arguments.
+    * ``hosts`` - a list of database hosts of a cluster to choose from in
+      place of the ``host``, see :class:`HostMonitor`.
+    * ``health_check_interval`` and ``health_check_timeout`` - parameters of
+      the :class:`HostMonitor` of ``hosts``, default is ``5`` and ``2``.
+    * ``strategy`` - ``"aiohttp"`` by default, or ``"aiohttp_fake"`` to use
+      a :class:`gino_aiohttp_fake.FakePool` instead of a database, see
+      :class:`FakeStrategy`.
     * ``pool_min_size`` - the initial number of connections of the db pool.
     * ``pool_max_size`` - the maximum number of connections in the db pool.
     * ``echo`` - enable SQLAlchemy echo mode.
     * ``ssl`` - SSL context passed to ``asyncpg.connect``, default is ``None``.
     * ``kwargs`` - other parameters passed to the specified dialects,
       like ``asyncpg``. Unrecognized parameters will cause exceptions.
+    * ``detect_long_lived`` - also use a :class:`ScopedConnection` for
+      websocket and server-sent event requests detected by their headers,
+      default is ``False``. A :class:`ScopedConnection` has no
+      ``get_raw_connection()``, ``raw_connection``, ``execution_options()``
+      or ``prepare()``, check handlers before turning this on.
+    * ``query_budget`` - default budget of all handlers as a dictionary with
+      optional keys ``statements``, ``duration`` and ``repeats``, see
+      :func:`query_budget`. Default is no budget.
+    * ``query_budget_action`` - what to do when a request goes over its
+      budget: ``"log"`` a warning (default), or ``"raise"``
+      :exc:`QueryBudgetExceeded` which is useful in debug or test mode.
+    * ``query_stats_callback`` - a callable taking the request and its
+      :class:`QueryStats`, called after each tracked request to emit metrics.
+    * ``tenant_resolver`` and ``tenant_config`` - enable multi-tenant routing
+      with a :class:`TenantRouter`, see its parameters for details.
+    * ``tenant_max_engines`` - the number of idle tenants to keep, default is
+      ``32``.
+    * ``tenant_idle_timeout`` - seconds to close an idle tenant engine,
+      default is ``300``.
+    * ``tenant_sweep_interval`` - seconds between checks for idle tenants,
+      default is ``60``.
+    * ``tenant_pool_min_size`` and ``tenant_pool_max_size`` - the default pool
+      sizes of tenant engines, default is ``0`` and ``5``.
+    * ``circuit_breaker`` - enable a :class:`CircuitBreaker` on the bound
+      engine, so that requests fail with ``503`` immediately during database
+      outages. Default is ``False``.
+    * ``circuit_breaker_threshold`` - the number of consecutive connection
+      failures to open the circuit, default is ``5``.
+    * ``circuit_breaker_timeout`` - seconds before probing the database again,
+      default is ``5``.
+    * ``write_behind_max_size``, ``write_behind_batch_size``,
+      ``write_behind_interval`` and ``write_behind_policy`` - parameters of
+      the :class:`WriteBehind` buffer of :meth:`defer_write`, default is
+      ``10000``, ``500``, ``1`` and ``"block"``.
+    * ``on_connect`` - a coroutine function or a list of them, called with
+      each new database connection once, see :meth:`on_connect`.
+    * ``on_acquire`` - a coroutine function or a list of them, called on
+      every connection borrow, see :meth:`on_acquire`.
+    * ``server_settings`` - a dictionary of session parameters like
+      ``search_path`` or ``statement_timeout``, sent when connecting, so they
+      cost no extra round trip and survive the reset on release.
+    * ``application_name`` - shortcut for the ``application_name`` in
+      ``server_settings``.
+    * ``identity_map`` - if ``True``, model instances loaded during a request
+      are kept by primary key in ``request['identity_map']``, so rows loaded
+      again in the same request reuse the existing instance instead of
+      creating a new one. The map is dropped together with
+      ``request['connection']`` on response, and is never used for
+      long-lived handlers. Default is ``False``.
+    * ``tracer`` - an OpenTelemetry ``Tracer``, or any object with a
+      compatible ``start_as_current_span()``, to trace requests. Default is
+      ``None``, tracing nothing at no cost.
+    * ``trace_extract`` - a callable taking the request headers and returning
+      the parent span context, default is ``opentelemetry.propagate.extract``
+      if installed.
+    * ``drain_timeout`` - seconds to wait for borrowed connections on
+      shutdown before cancelling their queries, see
+      :meth:`GinoEngine.shutdown`. New database work is refused from the
+      start of aiohttp's shutdown while in-flight requests finish, and the
+      pool is closed on cleanup. Default is ``10``.
 
     If the ``db`` is set as an aiohttp middleware, then a lazy connection is
     available at ``request['connection']``. By default, a database connection
@@ -99,22 +1547,228 @@ class Gino(_Gino):
 
         await request['connection'].release(permanent=False)
 
+    Long-lived handlers like websockets or server-sent events can be decorated
+    with :func:`scoped_connection` to get a :class:`ScopedConnection` at
+    ``request['connection']`` instead, which borrows a connection only for
+    each query or unit of work. They can also be detected by request headers
+    with the ``detect_long_lived`` config.
+
+    If a budget is declared by :func:`query_budget` or the ``query_budget``
+    config, or ``query_stats_callback`` is set, the number of statements and
+    the total database time of each request are tracked in a
+    :class:`QueryStats` at ``request['query_stats']``. Budgets are checked
+    even if the handler raises, e.g. ``HTTPNotFound``, then violations are
+    only logged. Cursors of ``iterate()`` count as one statement, taking the
+    time of all their fetches.
+
+    With tenant routing, the tenant key of the request is available at
+    ``request['tenant']``, and :attr:`bind` refers to the tenant engine during
+    the request.
+
+    With a ``tracer``, each request is traced in a span named after the
+    route, with child spans ``gino.acquire`` and ``gino.release`` of database
+    connections, and ``gino.query`` of each statement with the
+    :func:`fingerprint` of the SQL and the row count. Executions of prepared
+    statements get a ``gino.query`` span each, without the row count, and
+    cursors of ``iterate()`` one around their first fetch which runs the
+    statement.
+
     """
 
     model_base_classes = _Gino.model_base_classes + (AiohttpModelMixin,)
     query_executor = GinoExecutor
 
+    # Equivalent of decorating with ``aiohttp.web.middleware``, without
+    # importing aiohttp.web at module level.
+    __middleware_version__ = 1
+
+    detect_long_lived = False
+    identity_map = False
+    tracer = None
+    trace_extract = None
+    query_budget = None
+    query_budget_action = "log"
+    query_stats_callback = None
+    tenants = None
+    write_behind = None
+
+    def __init__(self, *args, **kwargs):
+        self._tenant_bind = ContextVar("gino_aiohttp_tenant_bind", default=None)
+        self.connect_hooks = []
+        self.acquire_hooks = []
+        super().__init__(*args, **kwargs)
+
+    @property
+    def bind(self):
+        rv = self._tenant_bind.get()
+        if rv is None:
+            rv = _Gino.bind.fget(self)
+        return rv
+
+    # noinspection PyMethodOverriding,PyAttributeOutsideInit
+    @bind.setter
+    def bind(self, bind):
+        self._bind = bind
+
     def __call__(self, request, handler):
-        return self._middleware(request, handler)
+        if self.tracer is None:
+            return self._middleware(request, handler)
+        return self._trace(request, handler)
+
+    async def _trace(self, request, handler):
+        context = None
+        if self.trace_extract is not None:
+            context = self.trace_extract(request.headers)
+        route = request.match_info.route.resource
+        route = request.path if route is None else route.canonical
+        with self.tracer.start_as_current_span(
+            "{} {}".format(request.method, route),
+            context=context,
+            attributes={
+                "http.method": request.method,
+                "http.route": route,
+                "http.target": request.path_qs,
+            },
+        ) as span:
+            token = _tracer.set(self.tracer)
+            try:
+                rv = await self._middleware(request, handler)
+            except Exception as e:
+                status = getattr(e, "status", None)
+                if isinstance(status, int):
+                    span.set_attribute("http.status_code", status)
+                raise
+            finally:
+                _tracer.reset(token)
+            span.set_attribute("http.status_code", rv.status)
+            return rv
+
+    def _get_budget(self, request):
+        route_budget = getattr(request.match_info.handler, "__gino_budget__", None)
+        if route_budget is None:
+            return self.query_budget
+        rv = dict(self.query_budget or {})
+        rv.update((k, v) for k, v in route_budget.items() if v is not None)
+        return rv
+
+    def _check_budget(self, request, stats, budget, log_only=False):
+        violations = []
+        statements = budget.get("statements")
+        if statements is not None and stats.statements > statements:
+            violations.append(
+                "{} statements over budget {}".format(stats.statements, statements)
+            )
+        duration = budget.get("duration")
+        if duration is not None and stats.duration > duration:
+            violations.append(
+                "{:.3f}s database time over budget {}s".format(stats.duration, duration)
+            )
+        repeats = budget.get("repeats")
+        if repeats is not None:
+            for fp, count in stats.repeated(repeats):
+                violations.append(
+                    "{} runs over budget {} of: {}".format(count, repeats, fp)
+                )
+        if not violations:
+            return
+        msg = "Query budget exceeded in {} {}: {}".format(
+            request.method, request.path, "; ".join(violations)
+        )
+        if self.query_budget_action == "raise" and not log_only:
+            raise QueryBudgetExceeded(msg)
+        logger.warning(msg)
+
+    def _is_long_lived(self, request):
+        scoped = getattr(request.match_info.handler, "__gino_scoped__", None)
+        if scoped is not None:
+            return scoped
+        if not self.detect_long_lived:
+            return False
+        headers = request.headers
+        if headers.get("Upgrade", "").lower() == "websocket":
+            return True
+        return "text/event-stream" in headers.get("Accept", "")
 
     async def _middleware(self, request, handler):
-        async with self.acquire(lazy=True) as connection:
-            request["connection"] = connection
+        tenants = self.tenants
+        if tenants is None:
+            return await self._serve(request, handler)
+        key = request["tenant"] = await tenants.resolve(request)
+        if key is None:
+            return await self._serve(request, handler)
+
+        tenant = await tenants.enter(self, key)
+        bind_token = self._tenant_bind.set(tenant.engine)
+        search_path_token = _search_path.set(tenant.search_path)
+        try:
+            return await self._serve(request, handler)
+        finally:
+            _search_path.reset(search_path_token)
+            self._tenant_bind.reset(bind_token)
+            tenants.leave(tenant)
+
+    async def _serve(self, request, handler):
+        budget = self._get_budget(request)
+        if budget is None and self.query_stats_callback is None:
+            return await self._handle(request, handler)
+
+        stats = request["query_stats"] = QueryStats()
+        token = _query_stats.set(stats)
+        raised = True
+        try:
+            rv = await self._handle(request, handler)
+            raised = False
+            return rv
+        finally:
+            _query_stats.reset(token)
+            if self.query_stats_callback is not None:
+                self.query_stats_callback(request, stats)
+            if budget:
+                # also for HTTP exceptions like 404, but only logged then
+                self._check_budget(request, stats, budget, raised)
+
+    async def _handle(self, request, handler):
+        bind = self.bind
+        token = None
+        if (
+            getattr(bind, "circuit_breaker", None) is not None
+            or getattr(bind, "host_monitor", None) is not None
+        ):
+            # errors of the handler itself are not database failures, only
+            # those of the statements it executes
+            token = _watched_engine.set(bind)
+        try:
+            return await self._with_connection(request, handler)
+        except DatabaseUnavailableError as e:
+            raise _unavailable(str(e)) from e
+        finally:
+            if token is not None:
+                _watched_engine.reset(token)
+
+    async def _with_connection(self, request, handler):
+        if self._is_long_lived(request):
+            request["connection"] = ScopedConnection(self)
             try:
                 return await handler(request)
             finally:
                 request.pop("connection", None)
 
+        token = None
+        if self.identity_map:
+            request["identity_map"] = {}
+            token = _identity_map.set(request["identity_map"])
+        try:
+            async with self.acquire(lazy=True) as connection:
+                request["connection"] = connection
+                try:
+                    return await handler(request)
+                finally:
+                    request.pop("connection", None)
+                    request.pop("identity_map", None)
+        finally:
+            if token is not None:
+                _identity_map.reset(token)
+
     def init_app(self, app, config=None, *, db_attr_name="db"):
         app[db_attr_name] = self
 
@@ -122,6 +1776,39 @@ class Gino(_Gino):
             config = app["config"].get("gino", {})
         else:
             config = config.copy()
+        self.detect_long_lived = config.setdefault("detect_long_lived", False)
+        self.identity_map = config.setdefault("identity_map", False)
+        self.tracer = config.setdefault("tracer")
+        self.trace_extract = config.setdefault(
+            "trace_extract", None if self.tracer is None else _otel_extract()
+        )
+        self.query_budget = config.setdefault("query_budget")
+        self.query_budget_action = config.setdefault("query_budget_action", "log")
+        self.query_stats_callback = config.setdefault("query_stats_callback")
+        for key, register in (
+            ("on_connect", self.on_connect),
+            ("on_acquire", self.on_acquire),
+        ):
+            hooks = config.setdefault(key, [])
+            for hook in hooks if isinstance(hooks, (list, tuple)) else [hooks]:
+                register(hook)
+        self.write_behind = WriteBehind(
+            max_size=config.setdefault("write_behind_max_size", 10000),
+            batch_size=config.setdefault("write_behind_batch_size", 500),
+            flush_interval=config.setdefault("write_behind_interval", 1),
+            policy=config.setdefault("write_behind_policy", "block"),
+        )
+        if config.get("tenant_resolver") is not None:
+            self.tenants = TenantRouter(
+                config["tenant_resolver"],
+                config["tenant_config"],
+                max_engines=config.setdefault("tenant_max_engines", 32),
+                idle_timeout=config.setdefault("tenant_idle_timeout", 300),
+                sweep_interval=config.setdefault("tenant_sweep_interval", 60),
+                pool_min_size=config.setdefault("tenant_pool_min_size", 0),
+                pool_max_size=config.setdefault("tenant_pool_max_size", 5),
+                write_behind=self.write_behind,
+            )
 
         async def before_server_start(_):
             if "dsn" in config:
@@ -136,6 +1823,25 @@ class Gino(_Gino):
                     database=config.setdefault("database", "postgres"),
                 )
 
+            kwargs = dict(config.setdefault("kwargs", dict()))
+            server_settings = dict(config.setdefault("server_settings", {}))
+            server_settings.update(kwargs.get("server_settings", {}))
+            if config.get("application_name") is not None:
+                server_settings["application_name"] = config["application_name"]
+            if server_settings:
+                kwargs["server_settings"] = server_settings
+            if config.get("hosts"):
+                kwargs["host_monitor"] = HostMonitor(
+                    config["hosts"],
+                    config.setdefault("health_check_interval", 5),
+                    config.setdefault("health_check_timeout", 2),
+                )
+            if config.setdefault("circuit_breaker", False):
+                kwargs["circuit_breaker"] = CircuitBreaker(
+                    config.setdefault("circuit_breaker_threshold", 5),
+                    config.setdefault("circuit_breaker_timeout", 5),
+                )
+
             retries = 0
             while True:
                 try:
@@ -145,7 +1851,8 @@ class Gino(_Gino):
                         min_size=config.setdefault("pool_min_size", 5),
                         max_size=config.setdefault("pool_max_size", 10),
                         ssl=config.setdefault("ssl"),
-                        **config.setdefault("kwargs", dict()),
+                        strategy=config.setdefault("strategy", AiohttpStrategy.name),
+                        **kwargs,
                     )
                     break
                 except Exception:
@@ -154,19 +1861,114 @@ class Gino(_Gino):
                         await asyncio.sleep(config.setdefault("retry_interval", 1))
                     else:
                         raise
+            self.write_behind.start()
+            if self.tenants is not None:
+                self.tenants.start()
+
+        async def before_server_stop(_):
+            # on_shutdown runs before aiohttp waits for in-flight handlers
+            drain_timeout = config.setdefault("drain_timeout", 10)
+            engines = []
+            if isinstance(self.bind, GinoEngine):
+                engines.append(self.bind.shutdown(drain_timeout))
+            if self.tenants is not None:
+                engines.append(self.tenants.shutdown(drain_timeout))
+            await asyncio.gather(*engines)
 
         async def after_server_stop(_):
+            await self.write_behind.stop()
+            if self.tenants is not None:
+                await self.tenants.close()
             await self.pop_bind().close()
 
         app.on_startup.append(before_server_start)
+        app.on_shutdown.append(before_server_stop)
         app.on_cleanup.append(after_server_stop)
 
     async def first_or_404(self, *args, **kwargs):
         rv = await self.first(*args, **kwargs)
         if rv is None:
-            raise HTTPNotFound(reason="No such data")
+            raise _not_found("No such data")
         return rv
 
+    async def rows(self, clause, *multiparams, **params):
+        return await self.bind.rows(clause, *multiparams, **params)
+
+    async def defer_write(self, clause, *multiparams, **params):
+        """Execute the given statement later in the background.
+
+        This is for writes that the response doesn't depend on, like audit
+        logs, last-seen timestamps or counters. The statement is buffered in
+        :attr:`write_behind` and executed in a batch on a separate connection,
+        so it doesn't cost a round trip in the request. Buffered writes are
+        flushed on cleanup. Without a started :class:`WriteBehind`, the
+        statement is executed immediately.
+
+        Write-behind statements bound to a tenant are executed on its engine.
+
+        """
+        write_behind = self.write_behind
+        if write_behind is None or not write_behind.started:
+            await self.bind.status(clause, *multiparams, **params)
+        else:
+            await write_behind.put(self.bind, None, (clause, multiparams, params))
+
+    async def defer_insert(self, table, values):
+        """Insert a row of ``values`` into ``table`` in the background.
+
+        Like :meth:`defer_write`, but rows of the same table are inserted with
+        multi-row ``INSERT`` statements.
+
+        """
+        write_behind = self.write_behind
+        if write_behind is None or not write_behind.started:
+            await self.bind.status(table.insert().values(**values))
+        else:
+            await write_behind.put(self.bind, table, values)
+
     async def set_bind(self, bind, loop=None, **kwargs):
-        kwargs.setdefault("strategy", "aiohttp")
+        strategy = kwargs.setdefault("strategy", AiohttpStrategy.name)
+        if strategy in (AiohttpStrategy.name, FakeStrategy.name):
+            self._install_hooks(kwargs)
         return await super().set_bind(bind, loop, **kwargs)
+
+    def _install_hooks(self, kwargs):
+        pool_class = kwargs.get("pool_class")
+        if pool_class is None and kwargs.get("strategy") == FakeStrategy.name:
+            from gino_aiohttp_fake import FakePool as pool_class
+        hooks = _ConnectionHooks(self, kwargs.get("setup"))
+        kwargs["setup"] = hooks.setup
+        kwargs["pool_class"] = hooks.pool_class(pool_class)
+        if kwargs.get("host_monitor") is not None:
+            kwargs["pool_class"] = kwargs["host_monitor"].pool_class(
+                kwargs["pool_class"]
+            )
+
+    def on_connect(self, hook):
+        """Register a coroutine function to set up new database connections.
+
+        The hook is called with the raw connection once per physical
+        connection, e.g. to register type codecs. Hooks registered after the
+        connections are created are applied on their next borrow, still only
+        once. Can be used as a decorator.
+
+        Session parameters don't belong here: asyncpg runs ``RESET ALL`` when
+        a connection is released, so a ``SET`` in this hook only lasts for
+        the first borrow. Use the ``server_settings`` or ``application_name``
+        config for them, or :meth:`on_acquire` for per-borrow state.
+
+        """
+        self.connect_hooks.append(hook)
+        return hook
+
+    def on_acquire(self, hook):
+        """Register a coroutine function called on every connection borrow.
+
+        asyncpg resets session state with ``RESET ALL`` when connections are
+        returned to the pool, so this is for per-borrow state only. Session
+        parameters that apply to all connections are cheaper to set with the
+        ``server_settings`` config. Can be used as a decorator.
+
+        """
+        self.acquire_hooks.append(hook)
+        return hook
@@ -0,0 +1,582 @@
+"""An in-process fake of asyncpg for GINO, no database needed.
+
+Imported on demand by the ``aiohttp_fake`` strategy of :mod:`gino_aiohttp`,
+see :class:`gino_aiohttp.FakeStrategy`.
+
+"""
+
+import asyncio
+import collections
+import itertools
+import re
+import sqlite3
+
+from asyncpg import ConnectionDoesNotExistError, InterfaceError, QueryCanceledError
+from gino.dialects.asyncpg import AsyncpgDialect, PreparedStatement
+from sqlalchemy import text
+from sqlalchemy.engine.url import URL
+
+_pg_params = re.compile(r"\$(\d+)")
+_pg_serial = re.compile(r"\b(?:SMALL|BIG)?SERIAL\b", re.IGNORECASE)
+_pg_session = ("SET", "RESET", "DISCARD")
+_pg_set = re.compile(
+    r"SET\s+(LOCAL\s+|SESSION\s+)?(\w+)\s*(?:TO|=)\s*(.*)", re.I | re.S
+)
+
+
+def _command(query):
+    return query.lstrip().split(None, 1)[0].upper() if query.strip() else ""
+
+
+def _status(query, count):
+    command = _command(query)
+    if command == "INSERT":
+        return "INSERT 0 {}".format(count)
+    if command in ("SELECT", "UPDATE", "DELETE"):
+        return "{} {}".format(command, count)
+    return command
+
+
+class FakeRecord:
+    """A row of :class:`FakePool` results, in place of :class:`asyncpg.Record`.
+
+    Values are accessed by index or by column name.
+
+    """
+
+    __slots__ = ("_keys", "_values")
+
+    def __init__(self, keys, values):
+        self._keys = keys
+        self._values = tuple(values)
+
+    def __getitem__(self, item):
+        if isinstance(item, str):
+            item = self._keys.index(item)
+        return self._values[item]
+
+    def __len__(self):
+        return len(self._values)
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __eq__(self, other):
+        if isinstance(other, FakeRecord):
+            return self._values == other._values
+        return self._values == other
+
+    def __hash__(self):
+        return hash(self._values)
+
+    def __repr__(self):
+        return "<FakeRecord {}>".format(
+            " ".join("{}={!r}".format(k, v) for k, v in self.items())
+        )
+
+    def get(self, key, default=None):
+        return self[key] if key in self._keys else default
+
+    def keys(self):
+        return iter(self._keys)
+
+    def values(self):
+        return iter(self._values)
+
+    def items(self):
+        return zip(self._keys, self._values)
+
+
+def _fake_records(rows):
+    rv = []
+    for row in rows:
+        if isinstance(row, FakeRecord):
+            rv.append(row)
+        elif isinstance(row, dict):
+            rv.append(FakeRecord(list(row), row.values()))
+        else:
+            row = tuple(row)
+            rv.append(FakeRecord(["?column?"] * len(row), row))
+    return rv
+
+
+class FakeConnection:
+    """A connection of :class:`FakePool`, in place of :class:`asyncpg.Connection`."""
+
+    def __init__(self, pool, pid):
+        self._pool = pool
+        self._pid = pid
+        self._closed = False
+        self._running = None
+        self._settings = None
+        self._reset()
+
+    def get_server_pid(self):
+        return self._pid
+
+    def is_closed(self):
+        return self._closed
+
+    async def close(self):
+        self._closed = True
+        # noinspection PyProtectedMember
+        self._pool._holders.pop(self._pid, None)
+
+    async def execute(self, query, *args, timeout=None):
+        status, _ = await self._pool._execute(self, query, args)
+        return status
+
+    async def fetch(self, query, *args, timeout=None):
+        _, rows = await self._pool._execute(self, query, args)
+        return rows
+
+    async def fetchrow(self, query, *args, timeout=None):
+        rows = await self.fetch(query, *args, timeout=timeout)
+        return rows[0] if rows else None
+
+    async def fetchval(self, query, *args, column=0, timeout=None):
+        row = await self.fetchrow(query, *args, timeout=timeout)
+        return None if row is None else row[column]
+
+    async def prepare(self, query, *, timeout=None):
+        return _FakePreparedStatement(self, query)
+
+    def transaction(self, **kwargs):
+        return _FakeTransaction(self)
+
+    def _reset(self):
+        # noinspection PyProtectedMember
+        self._settings = dict(self._pool._server_settings)
+
+    def _session(self, query):
+        command = _command(query)
+        if command == "SHOW":
+            name = query.split(None, 1)[1].strip().rstrip(";").lower()
+            return [FakeRecord([name], [self._settings.get(name)])]
+        match = _pg_set.match(query.strip())
+        if match is not None:
+            local, name, value = match.groups()
+            if not local:
+                self._settings[name.lower()] = value.strip().strip("'")
+        elif command == "DISCARD" or query.split()[1:2] == ["ALL"]:
+            self._reset()
+        elif command == "RESET":
+            name = query.split()[1].lower()
+            # noinspection PyProtectedMember
+            default = self._pool._server_settings.get(name)
+            self._settings.pop(name, None)
+            if default is not None:
+                self._settings[name] = default
+        return []
+
+    def _cancel(self, exc):
+        if self._running is not None and not self._running.done():
+            self._running.set_exception(exc)
+            return True
+        return False
+
+
+class _FakePreparedStatement:
+    # Nothing is prepared, the query is executed again on each fetch.
+
+    def __init__(self, conn, query):
+        self._conn = conn
+        self._query = query
+        self._status = None
+        self.keys = ()
+
+    async def fetch(self, *args, timeout=None):
+        # noinspection PyProtectedMember
+        self._status, rows = await self._conn._pool._execute(
+            self._conn, self._query, args
+        )
+        if rows:
+            self.keys = list(rows[0].keys())
+        return rows
+
+    async def fetchrow(self, *args, timeout=None):
+        rows = await self.fetch(*args, timeout=timeout)
+        return rows[0] if rows else None
+
+    def get_statusmsg(self):
+        return self._status
+
+    def get_attributes(self):
+        return ()
+
+    def cursor(self, *args, prefetch=None, timeout=None):
+        return _FakeRowCursor(self, args)
+
+
+class _FakeRowCursor:
+    # Fetches all rows on first use, for both iteration and awaiting.
+
+    def __init__(self, prepared, args):
+        self._prepared = prepared
+        self._args = args
+        self._rows = None
+
+    async def _fetch(self):
+        if self._rows is None:
+            self._rows = collections.deque(await self._prepared.fetch(*self._args))
+        return self._rows
+
+    def __await__(self):
+        return self._start().__await__()
+
+    async def _start(self):
+        await self._fetch()
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        rows = await self._fetch()
+        if not rows:
+            raise StopAsyncIteration
+        return rows.popleft()
+
+    async def fetch(self, n, *, timeout=None):
+        rows = await self._fetch()
+        return [rows.popleft() for _ in range(min(n, len(rows)))]
+
+    async def fetchrow(self, *, timeout=None):
+        rows = await self._fetch()
+        return rows.popleft() if rows else None
+
+    async def forward(self, n, *, timeout=None):
+        rows = await self._fetch()
+        n = min(n, len(rows))
+        for _ in range(n):
+            rows.popleft()
+        return n
+
+
+class _FakeTransaction:
+    # Savepoints on the shared SQLite database, not isolated between
+    # connections.
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._name = "gino_aiohttp_tx_{}".format(id(self))
+
+    @property
+    def raw_transaction(self):
+        return self
+
+    async def begin(self):
+        self._conn._pool._sqlite.execute("SAVEPOINT " + self._name)
+
+    async def commit(self):
+        self._conn._pool._sqlite.execute("RELEASE " + self._name)
+
+    async def rollback(self):
+        db = self._conn._pool._sqlite
+        db.execute("ROLLBACK TO " + self._name)
+        db.execute("RELEASE " + self._name)
+
+
+class _FakeCursor:
+    def __init__(self, dbapi_conn):
+        self._conn = dbapi_conn
+        self._keys = ()
+        self._status = None
+        self._prepared = None
+
+    def execute(self, statement, parameters):
+        pass
+
+    def executemany(self, statement, parameters):
+        pass
+
+    @property
+    def description(self):
+        keys = self._keys if self._prepared is None else self._prepared.keys
+        return [(key,) + (None,) * 6 for key in keys]
+
+    async def prepare(self, context, clause=None):
+        conn = await self._conn.acquire(timeout=context.timeout)
+        self._prepared = await conn.prepare(context.statement)
+        rv = PreparedStatement(self._prepared, clause)
+        rv.context = context
+        return rv
+
+    async def async_execute(self, query, timeout, args, limit=0, many=False):
+        conn = await self._conn.acquire(timeout=timeout)
+        # noinspection PyProtectedMember
+        self._status, rows = await conn._pool._execute(conn, query, args, many)
+        if many:
+            return None
+        if limit:
+            rows = rows[:limit]
+        self._keys = list(rows[0].keys()) if rows else ()
+        return rows
+
+    def get_statusmsg(self):
+        return self._status
+
+
+class FakePool:
+    """An in-process pool of :class:`FakeConnection`, no database needed.
+
+    Used by :class:`gino_aiohttp.FakeStrategy`, the keyword arguments below are accepted
+    by ``create_engine()`` or :meth:`Gino.set_bind` and the ``kwargs``
+    config. Statements are compiled for PostgreSQL as usual, and then:
+
+    :param results: scripted results - a callable taking the SQL statement
+      and arguments, or an iterable of items consumed per statement. Each
+      result is a list of rows as dictionaries, tuples or :class:`FakeRecord`,
+      or an exception instance to raise. ``None`` falls back to SQLite.
+    :param latency: seconds of simulated latency of each statement.
+    :param connect_latency: seconds to open each new connection.
+    :param sqlite: the SQLite database file, default is in memory.
+
+    Statements without a scripted result run in the SQLite database shared by
+    all connections of the pool. Only
+    ``$n`` parameters and ``SERIAL`` types are translated, so this works for
+    simple CRUD statements. The ``pg_backend_pid()``,
+    ``pg_cancel_backend()`` and ``pg_is_in_recovery()`` functions are
+    emulated. Session parameters are kept per connection from
+    ``server_settings`` and ``SET``, read by ``SHOW`` and reset on release
+    like asyncpg does. All executed statements and arguments are recorded in
+    :attr:`statements`.
+
+    """
+
+    def __init__(
+        self,
+        url,
+        loop,
+        *,
+        init=None,
+        setup=None,
+        min_size=0,
+        max_size=10,
+        results=None,
+        latency=0,
+        connect_latency=0,
+        sqlite=":memory:",
+        server_settings=None,
+        **kwargs,
+    ):
+        self._url = url
+        self._server_settings = dict(server_settings or {})
+        self._loop = loop
+        self._init = init
+        self._setup = setup
+        self._min_size = min_size
+        self._max_size = max_size
+        if results is not None and not callable(results):
+            results = iter(results)
+        self._results = results
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.statements = []
+        self._sqlite_path = sqlite
+        self._sqlite = None
+        self._current = None
+        self._pids = itertools.count(1)
+        self._free = []
+        self._holders = {}
+        self._semaphore = None
+        self._closing = False
+
+    def __await__(self):
+        return self._init_pool().__await__()
+
+    async def _init_pool(self):
+        self._sqlite = sqlite3.connect(self._sqlite_path, isolation_level=None)
+        self._sqlite.create_function(
+            "pg_backend_pid", 0, lambda: self._current.get_server_pid()
+        )
+        self._sqlite.create_function("pg_cancel_backend", 1, self._cancel)
+        self._sqlite.create_function("pg_is_in_recovery", 0, lambda: False)
+        self._semaphore = asyncio.Semaphore(self._max_size)
+        for _ in range(self._min_size):
+            self._free.append(await self._connect())
+        return self
+
+    @property
+    def raw_pool(self):
+        return self
+
+    async def _connect(self):
+        if self.connect_latency:
+            await asyncio.sleep(self.connect_latency)
+        rv = FakeConnection(self, next(self._pids))
+        self._holders[rv.get_server_pid()] = rv
+        if self._init is not None:
+            await self._init(rv)
+        return rv
+
+    async def connect(self):
+        """Open a connection outside of the pool."""
+        rv = FakeConnection(self, next(self._pids))
+        self._holders[rv.get_server_pid()] = rv
+        return rv
+
+    async def acquire(self, *, timeout=None):
+        if self._closing:
+            raise InterfaceError("pool is closed")
+        await asyncio.wait_for(self._semaphore.acquire(), timeout)
+        try:
+            if self._free:
+                rv = self._free.pop()
+            else:
+                rv = await self._connect()
+            if self._setup is not None:
+                await self._setup(rv)
+        except BaseException:
+            self._semaphore.release()
+            raise
+        return rv
+
+    async def release(self, conn):
+        if not conn.is_closed():
+            # like the RESET ALL of asyncpg
+            conn._reset()
+            self._free.append(conn)
+        self._semaphore.release()
+
+    def get_max_size(self):
+        return self._max_size
+
+    async def expire_connections(self):
+        self._close_all(self._free)
+        self._free.clear()
+
+    def terminate(self):
+        self._close_all(list(self._holders.values()))
+        self._free.clear()
+
+    def is_closing(self):
+        return self._closing
+
+    async def close(self):
+        self._closing = True
+        self.terminate()
+        if self._sqlite is not None:
+            self._sqlite.close()
+            self._sqlite = None
+
+    def _close_all(self, conns):
+        for conn in conns:
+            # noinspection PyProtectedMember
+            conn._closed = True
+            # noinspection PyProtectedMember
+            conn._cancel(ConnectionDoesNotExistError("connection was closed"))
+            self._holders.pop(conn.get_server_pid(), None)
+
+    def _cancel(self, pid):
+        conn = self._holders.get(pid)
+        if conn is None:
+            return False
+        # noinspection PyProtectedMember
+        return conn._cancel(
+            QueryCanceledError("canceling statement due to user request")
+        )
+
+    def _script(self, query, args):
+        results = self._results
+        if results is None:
+            return None
+        if callable(results):
+            return results(query, args)
+        return next(results, None)
+
+    async def _execute(self, conn, query, args, many=False):
+        if conn.is_closed():
+            raise ConnectionDoesNotExistError("connection was closed")
+        self.statements.append((query, args))
+        if self.latency:
+            waiter = conn._running = self._loop.create_future()
+            handle = self._loop.call_later(
+                self.latency,
+                lambda: waiter.done() or waiter.set_result(None),
+            )
+            try:
+                await waiter
+            finally:
+                handle.cancel()
+                conn._running = None
+
+        rows = self._script(query, args)
+        if rows is None:
+            return self._run_sqlite(conn, query, args, many)
+        if isinstance(rows, BaseException):
+            raise rows
+        rows = _fake_records(rows)
+        return _status(query, len(rows)), rows
+
+    def _run_sqlite(self, conn, query, args, many):
+        if _command(query) in _pg_session + ("SHOW",):
+            # noinspection PyProtectedMember
+            return _command(query), conn._session(query)
+        query = _pg_serial.sub("INTEGER", _pg_params.sub(r"?\1", query))
+        self._current = conn
+        if many:
+            cursor = self._sqlite.executemany(query, args)
+            return _status(query, cursor.rowcount), []
+        cursor = self._sqlite.execute(query, args)
+        rows = cursor.fetchall()
+        count = len(rows) if cursor.rowcount < 0 else cursor.rowcount
+        keys = [d[0] for d in cursor.description or ()]
+        return _status(query, count), [FakeRecord(keys, row) for row in rows]
+
+    def repr(self, color):
+        return "<FakePool max={} min={} cur={} use={}>".format(
+            self._max_size,
+            self._min_size,
+            len(self._holders),
+            len(self._holders) - len(self._free),
+        )
+
+
+class FakeDialect(AsyncpgDialect):
+    """The asyncpg dialect of GINO on a :class:`FakePool`."""
+
+    driver = "aiohttp_fake"
+    cursor_cls = _FakeCursor
+    init_kwargs = AsyncpgDialect.init_kwargs | {
+        "results",
+        "latency",
+        "connect_latency",
+        "sqlite",
+    }
+
+    async def init_pool(self, url, loop, pool_class=None):
+        if pool_class is None:
+            pool_class = FakePool
+        return await pool_class(url, loop, init=self.on_connect(), **self._pool_kwargs)
+
+    # noinspection PyMethodMayBeStatic
+    def transaction(self, raw_conn, args, kwargs):
+        return raw_conn.transaction(**kwargs)
+
+    async def has_table(self, connection, table_name, schema=None):
+        row = await connection.first(
+            text(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name = :name"
+            ).bindparams(name=table_name)
+        )
+        return bool(row)
+
+
+class FakeURL(URL):
+    """A database URL of :class:`FakeDialect` whatever its driver name."""
+
+    def get_dialect(self):
+        return FakeDialect
+
+    @classmethod
+    def from_url(cls, url):
+        return cls(
+            url.drivername,
+            url.username,
+            url.password,
+            url.host,
+            url.port,
+            url.database,
+            url.query,
+        )
@@ -13,7 +13,13 @@ import pytest
 import requests
 from aiohttp import web
 from async_generator import yield_, async_generator
-from gino.ext.aiohttp import Gino
+from gino.ext.aiohttp import (
+    Gino,
+    ScopedConnection,
+    json_dumps,
+    query_budget,
+    scoped_connection,
+)
 from requests.adapters import HTTPAdapter
 from urllib3 import Retry
 
@@ -314,6 +320,94 @@ async def _app(config, in_app_config=True, db_delayed=False):
         await request["connection"].first_or_404(u.query)
         return web.json_response(u.to_dict())
 
+    @routes.get("/scoped/users/{uid}")
+    @scoped_connection
+    async def get_user_scoped(request):
+        assert isinstance(request["connection"], ScopedConnection)
+        uid = int(request.match_info["uid"])
+        q = User.query.where(User.id == uid)
+        async with request["connection"].acquire() as conn:
+            assert db.bind.current_connection is conn
+            await conn.first_or_404(q)
+        assert db.bind.current_connection is None
+        return web.json_response(
+            (await request["connection"].first_or_404(q)).to_dict()
+        )
+
+    @routes.get("/ws")
+    @scoped_connection
+    async def ws_handler(request):
+        assert isinstance(request["connection"], ScopedConnection)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for msg in ws:
+            u = await User.get(int(msg.data))
+            assert db.bind.current_connection is None
+            await ws.send_json(u.to_dict() if u else None)
+        return ws
+
+    @routes.get("/budget")
+    @query_budget(statements=2, repeats=2)
+    async def budget(request):
+        for i in range(int(request.query["n"])):
+            await db.scalar("SELECT {}".format(i))
+        return web.json_response(request["query_stats"].fingerprints)
+
+    @routes.post("/users/later")
+    async def add_user_later(request):
+        form = await request.post()
+        await User.create_later(nickname=form.get("name"))
+        await db.defer_write(
+            User.update.values(nickname=User.nickname + "!").where(
+                User.nickname == form.get("name")
+            )
+        )
+        return web.json_response(len(db.write_behind))
+
+    @routes.get("/settings")
+    async def settings(request):
+        return web.json_response(
+            dict(
+                application_name=await db.scalar("SHOW application_name"),
+                pid=await db.scalar("SELECT pg_backend_pid()"),
+            )
+        )
+
+    @routes.get("/rows")
+    async def rows(request):
+        method = request.query.get("method")
+        q = User.query.order_by(User.id)
+        if method == "1":
+            rv = await request["connection"].rows(q)
+        elif method == "2":
+            rv = await db.rows(q)
+        else:
+            rv = await q.gino.rows()
+        return web.json_response(rv, dumps=json_dumps)
+
+    @routes.get("/tenant")
+    async def tenant(request):
+        return web.json_response(
+            dict(
+                tenant=request["tenant"],
+                search_path=await db.scalar("SHOW search_path"),
+                users=await db.func.count(User.id).gino.scalar(),
+            )
+        )
+
+    @routes.get("/identity/{uid}")
+    async def identity(request):
+        uid = int(request.match_info["uid"])
+        user = await User.get_or_404(uid)
+        same = await User.query.where(User.id == uid).gino.first() is user
+        users = await User.query.order_by(User.id).gino.all()
+        return web.json_response(
+            dict(
+                same=same and users[0] is user,
+                size=len(request["identity_map"]),
+            )
+        )
+
     app.router.add_routes(routes)
 
     e = await gino.create_engine(PG_URL)
@@ -345,6 +439,59 @@ async def app_ssl(ssl_ctx, request):
     await _app(dict(dsn=PG_URL, ssl=ssl_ctx), request.param)
 
 
+@pytest.fixture
+@async_generator
+async def app_hosts():
+    config = DB_ARGS.copy()
+    config["hosts"] = [
+        "localhost:{}".format(find_free_port()),
+        "{host}:{port}".format(**DB_ARGS),
+    ]
+    config["health_check_interval"] = 0.2
+    await _app(config)
+
+
+@pytest.fixture
+@async_generator
+async def app_identity_map():
+    await _app(dict(DB_ARGS, identity_map=True))
+
+
+@pytest.fixture
+@async_generator
+async def app_circuit_breaker():
+    await _app(dict(DB_ARGS, circuit_breaker=True, circuit_breaker_timeout=0.2))
+
+
+@pytest.fixture
+@async_generator
+async def app_tenants():
+    config = DB_ARGS.copy()
+    config["tenant_resolver"] = lambda request: request.headers.get("X-Tenant")
+    config["tenant_config"] = lambda key: (
+        dict(dsn=PG_URL) if key == "dsn" else dict(search_path=[key, "public"])
+    )
+    await _app(config)
+
+
+@pytest.fixture
+def connected():
+    return set()
+
+
+@pytest.fixture
+@async_generator
+async def app_hooks(connected):
+    async def on_connect(conn):
+        assert conn.get_server_pid() not in connected
+        connected.add(conn.get_server_pid())
+
+    config = DB_ARGS.copy()
+    config["application_name"] = "gino_aiohttp_test"
+    config["on_connect"] = on_connect
+    await _app(config)
+
+
 @pytest.fixture(params=[True, False])
 @async_generator
 async def app_db_delayed(request):
@@ -0,0 +1,636 @@
+import asyncio
+import contextlib
+from contextvars import ContextVar
+
+import asyncpg
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from gino.ext.aiohttp import CircuitBreaker, Gino, HostMonitor, query_budget
+from gino_aiohttp_fake import FakePool
+
+pytestmark = pytest.mark.asyncio
+
+
+def _app(**config):
+    db = Gino()
+    app = web.Application(middlewares=[db])
+    db.init_app(app, dict(strategy="aiohttp_fake", **config))
+
+    class User(db.Model):
+        __tablename__ = "gino_users"
+
+        id = db.Column(db.BigInteger(), primary_key=True)
+        nickname = db.Column("name", db.Unicode(), default="noname")
+
+    async def get_user(request):
+        uid = int(request.match_info["uid"])
+        if request.query.get("method") == "1":
+            user = await User.query.where(User.id == uid).gino.first_or_404()
+        else:
+            user = await User.get_or_404(uid)
+        return web.json_response(user.to_dict())
+
+    async def add_user(request):
+        user = await User.create(nickname=(await request.post()).get("name"))
+        return web.json_response(user.to_dict())
+
+    async def identity(request):
+        uid = int(request.match_info["uid"])
+        partial = await db.select([User.id]).gino.load(User.load("id")).first()
+        user = await User.get(uid)
+        same = await User.query.where(User.id == uid).gino.first() is user
+        return web.json_response(
+            dict(user.to_dict(), partial=partial is user, same=same)
+        )
+
+    async def prepared(request):
+        async with db.acquire() as conn:
+            query = User.query.where(User.id == db.bindparam("uid"))
+            user = await (await conn.prepare(query)).first(
+                uid=int(request.match_info["uid"])
+            )
+            stmt = await conn.prepare(User.query.order_by(User.id))
+            names = [u.nickname async for u in stmt.iterate()]
+            cursor = await stmt.iterate()
+            await cursor.forward(1)
+            forward = await cursor.next()
+        return web.json_response(
+            dict(nickname=user and user.nickname, names=names, forward=forward.nickname)
+        )
+
+    async def add_later(request):
+        await User.create_later(nickname=request.query["name"])
+        return web.Response()
+
+    async def fail(request):
+        if request.query.get("error") == "timeout":
+            await asyncio.wait_for(asyncio.sleep(1), 0.001)
+        raise FileNotFoundError("no such file")
+
+    async def timeouts(request):
+        rv = 0
+        for _ in range(int(request.query["n"])):
+            try:
+                await db.scalar("SELECT 1")
+            except asyncio.TimeoutError:
+                rv += 1
+        return web.json_response(rv)
+
+    @query_budget(repeats=2)
+    async def budget(request):
+        for _ in range(3):
+            await db.scalar("SELECT 1")
+        await User.get_or_404(int(request.match_info["uid"]))
+        return web.Response()
+
+    @query_budget(statements=5)
+    async def iterate(request):
+        async with db.transaction():
+            names = [u.nickname async for u in db.iterate(User.query)]
+        stats = request["query_stats"]
+        return web.json_response(
+            dict(names=names, statements=stats.statements, duration=stats.duration)
+        )
+
+    async def ws_pid(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for _ in ws:
+            raw_conn = await request["connection"].get_raw_connection()
+            await ws.send_json(raw_conn.get_server_pid())
+        return ws
+
+    async def settings(request):
+        return web.json_response(
+            dict(
+                application_name=await db.scalar("SHOW application_name"),
+                statement_timeout=await db.scalar("SHOW statement_timeout"),
+            )
+        )
+
+    app.router.add_get("/users/{uid}", get_user)
+    app.router.add_get("/settings", settings)
+    app.router.add_get("/ws", ws_pid)
+    app.router.add_get("/budget/{uid}", budget)
+    app.router.add_get("/iterate", iterate)
+    app.router.add_get("/timeouts", timeouts)
+    app.router.add_post("/users", add_user)
+    app.router.add_get("/fail", fail)
+    app.router.add_get("/users/later", add_later)
+    app.router.add_get("/identity/{uid}", identity)
+    app.router.add_get("/prepared/{uid}", prepared)
+    return app
+
+
+async def test_sqlite():
+    app = _app()
+    async with TestClient(TestServer(app)) as client:
+        db = app["db"]
+        assert isinstance(db.bind.raw_pool, FakePool)
+        await db.gino.create_all()
+
+        for method in "01":
+            response = await client.get("/users/1?method=" + method)
+            assert response.status == 404
+
+        response = await client.post("/users", data=dict(name="fantix"))
+        assert response.status == 200
+        assert await response.json() == dict(id=1, nickname="fantix")
+
+        for method in "01":
+            response = await client.get("/users/1?method=" + method)
+            assert response.status == 200
+            assert await response.json() == dict(id=1, nickname="fantix")
+
+
+async def test_prepare():
+    app = _app()
+    async with TestClient(TestServer(app)) as client:
+        await app["db"].gino.create_all()
+        for name in ("fantix", "tony"):
+            response = await client.post("/users", data=dict(name=name))
+            assert response.status == 200
+
+        for uid, nickname in ((2, "tony"), (3, None)):
+            response = await client.get("/prepared/{}".format(uid))
+            assert response.status == 200
+            assert await response.json() == dict(
+                nickname=nickname, names=["fantix", "tony"], forward="tony"
+            )
+
+
+async def test_query_budget(caplog):
+    app = _app(query_budget_action="raise")
+    async with TestClient(TestServer(app)) as client:
+        await app["db"].gino.create_all()
+        response = await client.get("/budget/1")
+        assert response.status == 404
+        assert "3 runs over budget 2 of: SELECT ?" in caplog.text
+
+        response = await client.post("/users", data=dict(name="fantix"))
+        assert response.status == 200
+        response = await client.get("/budget/1")
+        assert response.status == 500
+
+        app["db"].bind.raw_pool.latency = 0.01
+        response = await client.get("/iterate")
+        assert response.status == 200
+        data = await response.json()
+        assert data["names"] == ["fantix"]
+        assert data["statements"] == 1
+        assert data["duration"] >= 0.01
+
+
+async def test_websocket_keeps_connection():
+    # not detected as long-lived by default, so the raw connection is there
+    app = _app()
+    async with TestClient(TestServer(app)) as client:
+        async with client.ws_connect("/ws") as ws:
+            pids = []
+            for _ in range(2):
+                await ws.send_str("pid")
+                pids.append(await ws.receive_json())
+            assert pids[0] == pids[1]
+
+
+async def test_scripted():
+    app = _app(kwargs=dict(results=[[dict(id=7, name="fake")], []], latency=0.01))
+    async with TestClient(TestServer(app)) as client:
+        response = await client.get("/users/7")
+        assert response.status == 200
+        assert await response.json() == dict(id=7, nickname="fake")
+
+        response = await client.get("/users/7")
+        assert response.status == 404
+
+        statements = app["db"].bind.raw_pool.statements
+        assert [list(args) for _, args in statements] == [[7], [7]]
+
+
+async def test_identity_map():
+    app = _app(identity_map=True)
+    async with TestClient(TestServer(app)) as client:
+        await app["db"].gino.create_all()
+        response = await client.post("/users", data=dict(name="fantix"))
+        assert response.status == 200
+
+        response = await client.get("/identity/1")
+        assert response.status == 200
+        assert await response.json() == dict(
+            id=1, nickname="fantix", partial=False, same=True
+        )
+
+
+async def test_write_behind_tenants():
+    app = _app(
+        tenant_resolver=lambda request: request.headers.get("X-Tenant"),
+        tenant_config=lambda key: dict(search_path=key),
+        write_behind_interval=0.1,
+    )
+    async with TestClient(TestServer(app)) as client:
+        db = app["db"]
+        await db.gino.create_all()
+        statements = db.bind.raw_pool.statements
+        del statements[:]
+        for tenant, name in (("a", "fantix"), ("b", "tony"), ("a", "wwwjfy")):
+            response = await client.get(
+                "/users/later?name=" + name, headers={"X-Tenant": tenant}
+            )
+            assert response.status == 200
+        await asyncio.sleep(0.3)
+
+    statements = [
+        (query.split("(")[0].strip(), list(args))
+        for query, args in statements
+        if "search_path TO" not in query or query.startswith("SET LOCAL")
+    ]
+    assert statements == [
+        ('SET LOCAL search_path TO "a"', []),
+        ("INSERT INTO gino_users", ["fantix"]),
+        ('SET LOCAL search_path TO "b"', []),
+        ("INSERT INTO gino_users", ["tony"]),
+        ('SET LOCAL search_path TO "a"', []),
+        ("INSERT INTO gino_users", ["wwwjfy"]),
+    ]
+
+
+async def test_write_behind_failures(caplog):
+    def results(query, args):
+        if "bad" in args:
+            return asyncpg.UniqueViolationError("duplicate key value")
+        return []
+
+    app = _app(
+        tenant_resolver=lambda request: request.headers.get("X-Tenant"),
+        tenant_config=lambda key: dict(
+            dsn="postgresql://localhost/" + key,
+            kwargs=dict(strategy="aiohttp_fake", results=results),
+        ),
+        write_behind_interval=10,
+    )
+    async with TestClient(TestServer(app)) as client:
+        db = app["db"]
+        for tenant, name in (
+            ("a", "fantix"),
+            ("a", "bad"),
+            ("a", "wwwjfy"),
+            ("b", "tony"),
+            ("c", "lost"),
+        ):
+            response = await client.get(
+                "/users/later?name=" + name, headers={"X-Tenant": tenant}
+            )
+            assert response.status == 200
+        pools = {
+            key: tenant.engine.raw_pool for key, tenant in db.tenants._tenants.items()
+        }
+        await db.tenants._tenants["c"].engine.close()
+        await db.write_behind.flush()
+
+    def inserted(pool):
+        return [args for query, args in pool.statements if query.startswith("INSERT")]
+
+    assert inserted(pools["a"]) == [
+        ["fantix", "bad", "wwwjfy"],
+        ["fantix"],
+        ["bad"],
+        ["wwwjfy"],
+    ]
+    assert inserted(pools["b"]) == [["tony"]]
+    assert inserted(pools["c"]) == []
+    assert "Failed to flush 3 deferred writes, retrying one by one" in caplog.text
+    assert caplog.text.count("Failed to flush a deferred write") == 2
+
+
+async def test_tenant_eviction_flushes_writes():
+    app = _app(
+        tenant_resolver=lambda request: request.headers.get("X-Tenant"),
+        tenant_config=lambda key: dict(
+            dsn="postgresql://localhost/" + key,
+            kwargs=dict(strategy="aiohttp_fake", results=lambda *_: []),
+        ),
+        tenant_max_engines=1,
+        write_behind_interval=10,
+    )
+    async with TestClient(TestServer(app)) as client:
+        tenants = app["db"].tenants
+        response = await client.get(
+            "/users/later?name=fantix", headers={"X-Tenant": "a"}
+        )
+        assert response.status == 200
+        raw_pool = tenants._tenants["a"].engine.raw_pool
+
+        response = await client.get("/users/1", headers={"X-Tenant": "b"})
+        assert response.status == 404
+        assert "a" not in tenants
+        await asyncio.sleep(0.1)
+        assert raw_pool.is_closing()
+        assert [
+            args for query, args in raw_pool.statements if query.startswith("INSERT")
+        ] == [["fantix"]]
+
+
+async def test_tenant_created_once():
+    created = []
+
+    async def tenant_config(key):
+        created.append(key)
+        await asyncio.sleep(0.1)
+        if len(created) == 1:
+            raise RuntimeError("config unavailable")
+        return dict(
+            dsn="postgresql://localhost/" + key,
+            kwargs=dict(strategy="aiohttp_fake", results=lambda *_: []),
+        )
+
+    app = _app(
+        tenant_resolver=lambda request: request.headers.get("X-Tenant"),
+        tenant_config=tenant_config,
+    )
+    async with TestClient(TestServer(app)) as client:
+
+        async def get(delay):
+            await asyncio.sleep(delay)
+            response = await client.get("/users/1", headers={"X-Tenant": "a"})
+            return response.status
+
+        # the third request arrives after the first creation failed
+        assert await asyncio.gather(get(0), get(0.01), get(0.15)) == [500, 404, 404]
+        assert created == ["a", "a"]
+
+
+async def test_tenant_sweep():
+    app = _app(
+        tenant_resolver=lambda request: request.headers.get("X-Tenant"),
+        tenant_config=lambda key: dict(
+            dsn="postgresql://localhost/" + key,
+            kwargs=dict(strategy="aiohttp_fake", results=lambda *_: []),
+        ),
+        tenant_idle_timeout=0.1,
+        tenant_sweep_interval=0.05,
+    )
+    async with TestClient(TestServer(app)) as client:
+        tenants = app["db"].tenants
+        response = await client.get("/users/1", headers={"X-Tenant": "a"})
+        assert response.status == 404
+        assert "a" in tenants
+        raw_pool = tenants._tenants["a"].engine.raw_pool
+        assert not raw_pool.is_closing()
+
+        # closed by the sweeper without any further requests
+        await asyncio.sleep(0.3)
+        assert "a" not in tenants
+        assert raw_pool.is_closing()
+
+
+async def test_connection_hooks():
+    connected = []
+    late = []
+
+    async def on_connect(conn):
+        connected.append(conn.get_server_pid())
+
+    app = _app(pool_max_size=2, on_connect=on_connect)
+    async with TestClient(TestServer(app)) as client:
+        db = app["db"]
+        await db.gino.create_all()
+        for _ in range(3):
+            response = await client.get("/users/1")
+            assert response.status == 404
+        assert len(connected) == len(set(connected))
+
+        @db.on_connect
+        async def late_hook(conn):
+            late.append(conn.get_server_pid())
+
+        for _ in range(3):
+            response = await client.get("/users/1")
+            assert response.status == 404
+        assert late and sorted(late) == sorted(set(late))
+        assert set(late) <= set(connected)
+
+
+async def test_on_connect_set_is_reset():
+    async def on_connect(conn):
+        await conn.execute("SET statement_timeout TO '5s'")
+
+    app = _app(
+        pool_max_size=1, on_connect=on_connect, application_name="gino_aiohttp_test"
+    )
+    async with TestClient(TestServer(app)) as client:
+        # the same connection, but RESET ALL on release undid the SET
+        for statement_timeout in ("5s", None, None):
+            response = await client.get("/settings")
+            assert response.status == 200
+            assert await response.json() == dict(
+                application_name="gino_aiohttp_test",
+                statement_timeout=statement_timeout,
+            )
+
+
+async def test_circuit_breaker_ignores_handler_errors():
+    app = _app(circuit_breaker=True, circuit_breaker_threshold=2)
+    async with TestClient(TestServer(app)) as client:
+        await app["db"].gino.create_all()
+        for error in ("file", "timeout") * 2:
+            response = await client.get("/fail?error=" + error)
+            assert response.status >= 500
+
+        response = await client.get("/users/1")
+        assert response.status == 404
+        assert app["db"].bind.circuit_breaker.state == CircuitBreaker.CLOSED
+
+
+async def test_circuit_breaker_ignores_statement_timeouts():
+    app = _app(
+        circuit_breaker=True,
+        circuit_breaker_threshold=3,
+        kwargs=dict(
+            results=lambda query, args: (
+                asyncio.TimeoutError() if query == "SELECT 1" else []
+            )
+        ),
+    )
+    async with TestClient(TestServer(app)) as client:
+        response = await client.get("/timeouts?n=3")
+        assert response.status == 200
+        assert await response.json() == 3
+        assert app["db"].bind.circuit_breaker.state == CircuitBreaker.CLOSED
+
+        response = await client.get("/users/1")
+        assert response.status == 404
+
+
+async def test_circuit_breaker_probe():
+    breaker = CircuitBreaker(1, 0.05)
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    await asyncio.sleep(0.05)
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.abort()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    # a probe that never reports back is retried
+    assert breaker.allow()
+    assert not breaker.allow()
+    await asyncio.sleep(0.05)
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+async def test_host_monitor_hosts():
+    monitor = HostMonitor(
+        ["db1", "db2:5433", "::1", "[::1]", "[fe80::1]:5434", ("db3", 5435)]
+    )
+    assert monitor.hosts == [
+        ("db1", None),
+        ("db2", 5433),
+        ("::1", None),
+        ("::1", None),
+        ("fe80::1", 5434),
+        ("db3", 5435),
+    ]
+
+
+async def test_host_monitor_margin():
+    a, b = ("a", 5432), ("b", 5432)
+    monitor = HostMonitor([a, b])
+    monitor.writable = {a: True, b: True}
+    monitor.latency = {a: 0.010, b: 0.012}
+    assert monitor.best() == a
+    monitor.current = a
+
+    # similar latency, stay on the current host
+    monitor.latency = {a: 0.012, b: 0.010}
+    assert monitor.best() == a
+
+    # clearly slower
+    monitor.latency = {a: 0.020, b: 0.010}
+    assert monitor.best() == b
+
+    # no longer writable
+    monitor.latency = {a: 0.010, b: 0.012}
+    monitor.writable[a] = False
+    assert monitor.best() == b
+
+
+async def test_drain():
+    app = _app(kwargs=dict(latency=10))
+    async with TestClient(TestServer(app)):
+        engine = app["db"].bind
+
+        async def work():
+            async with engine.acquire() as conn:
+                await conn.scalar("SELECT 1")
+
+        task = asyncio.ensure_future(work())
+        await asyncio.sleep(0.1)
+        engine.raw_pool.latency = 0
+        assert await engine.drain(0.1) == dict(released=0, cancelled=1, terminated=0)
+        with pytest.raises(asyncpg.QueryCanceledError):
+            await task
+
+
+async def test_drain_on_shutdown(caplog):
+    app = _app(pool_min_size=1, pool_max_size=1, drain_timeout=0.1)
+    client = TestClient(TestServer(app))
+    await client.start_server()
+    engine = app["db"].bind
+    engine.raw_pool.latency = 10
+
+    task = asyncio.ensure_future(client.get("/users/1"))
+    await asyncio.sleep(0.1)
+    engine.raw_pool.latency = 0
+    # the request holds the whole pool, it is cancelled over a dedicated
+    # connection before aiohttp waits for it
+    with caplog.at_level("INFO", "gino_aiohttp"):
+        await asyncio.wait_for(client.server.close(), 5)
+    assert "0 released, 1 cancelled, 0 terminated" in caplog.text
+    response = await task
+    assert response.status == 500
+    await client.close()
+
+
+class Span:
+    def __init__(self, name, parent, context, attributes):
+        self.name = name
+        self.parent = parent
+        self.context = context
+        self.attributes = dict(attributes or {})
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+
+class Tracer:
+    def __init__(self):
+        self.spans = []
+        self._current = ContextVar("current_span", default=None)
+
+    @contextlib.contextmanager
+    def start_as_current_span(self, name, context=None, attributes=None):
+        span = Span(name, self._current.get(), context, attributes)
+        self.spans.append(span)
+        token = self._current.set(span)
+        try:
+            yield span
+        finally:
+            self._current.reset(token)
+
+
+async def test_tracing():
+    tracer = Tracer()
+    app = _app(tracer=tracer, trace_extract=lambda headers: headers.get("traceparent"))
+    async with TestClient(TestServer(app)) as client:
+        await app["db"].gino.create_all()
+        assert tracer.spans == []
+
+        response = await client.post(
+            "/users", data=dict(name="fantix"), headers=dict(traceparent="00-1")
+        )
+        assert response.status == 200
+        response = await client.get("/users/2")
+        assert response.status == 404
+
+    request, acquire, query, release = tracer.spans[:4]
+    assert request.name == "POST /users"
+    assert request.context == "00-1"
+    assert request.attributes["http.status_code"] == 200
+    assert acquire.name == "gino.acquire" and acquire.parent is request
+    assert query.name == "gino.query" and query.parent is request
+    assert query.attributes["db.statement"].startswith("INSERT INTO gino_users")
+    assert query.attributes["db.row_count"] == 1
+    assert release.name == "gino.release" and release.parent is request
+
+    request = tracer.spans[4]
+    assert request.name == "GET /users/{uid}"
+    assert request.context is None
+    assert request.attributes["http.status_code"] == 404
+    assert tracer.spans[6].attributes["db.row_count"] == 0
+
+
+async def test_tracing_prepared():
+    tracer = Tracer()
+    app = _app(tracer=tracer)
+    async with TestClient(TestServer(app)) as client:
+        await app["db"].gino.create_all()
+        for name in ("fantix", "tony"):
+            response = await client.post("/users", data=dict(name=name))
+            assert response.status == 200
+        del tracer.spans[:]
+
+        response = await client.get("/prepared/1")
+        assert response.status == 200
+
+    queries = [span for span in tracer.spans if span.name == "gino.query"]
+    # first(), the iterated cursor and the awaited cursor
+    assert len(queries) == 3
+    assert queries[0].attributes["db.statement"].endswith("WHERE gino_users.id = $?")
+    for span in queries[1:]:
+        assert span.attributes["db.statement"].endswith("ORDER BY gino_users.id")
+    assert all(span.parent is tracer.spans[0] for span in queries)
@@ -1,5 +1,6 @@
 import asyncio
 
+import asyncpg
 import pytest
 from aiohttp.test_utils import TestClient, TestServer
 
@@ -56,3 +57,181 @@ async def test_db_delayed(app_db_delayed):
     loop = asyncio.get_event_loop()
     loop.call_later(1, loop.create_task, app_db_delayed.start_proxy())
     await _test(app_db_delayed)
+
+
+async def test_scoped(app):
+    async with TestClient(TestServer(app)) as client:
+        response = await client.get("/scoped/users/1")
+        assert response.status == 404
+
+        response = await client.post("/users", data=dict(name="fantix"))
+        assert response.status == 200
+
+        response = await client.get("/scoped/users/1")
+        assert response.status == 200
+        assert await response.json() == dict(id=1, nickname="fantix")
+
+        async with client.ws_connect("/ws") as ws:
+            for uid, expected in (
+                ("1", dict(id=1, nickname="fantix")),
+                ("2", None),
+            ):
+                await ws.send_str(uid)
+                assert await ws.receive_json() == expected
+
+
+async def test_query_budget(app, caplog):
+    async with TestClient(TestServer(app)) as client:
+        response = await client.get("/budget?n=2")
+        assert response.status == 200
+        assert await response.json() == {"SELECT ?": 2}
+        assert "Query budget exceeded" not in caplog.text
+
+        response = await client.get("/budget?n=3")
+        assert response.status == 200
+        assert await response.json() == {"SELECT ?": 3}
+        assert "3 statements over budget 2" in caplog.text
+        assert "3 runs over budget 2 of: SELECT ?" in caplog.text
+
+        app["gino_db"].query_budget_action = "raise"
+        response = await client.get("/budget?n=3")
+        assert response.status == 500
+
+
+async def test_tenant(app_tenants):
+    tenants = app_tenants["gino_db"].tenants
+    async with TestClient(TestServer(app_tenants)) as client:
+        response = await client.post("/users", data=dict(name="fantix"))
+        assert response.status == 200
+
+        response = await client.get("/tenant")
+        assert response.status == 200
+        default = await response.json()
+        assert default["tenant"] is None
+        assert default["users"] == 1
+
+        response = await client.get("/tenant", headers={"X-Tenant": "pg_catalog"})
+        assert response.status == 200
+        data = await response.json()
+        assert data["tenant"] == "pg_catalog"
+        assert data["search_path"] == "pg_catalog, public"
+        assert data["users"] == 1
+        assert "pg_catalog" in tenants
+
+        response = await client.get("/tenant")
+        assert await response.json() == default
+
+        response = await client.get("/tenant", headers={"X-Tenant": "dsn"})
+        assert response.status == 200
+        data = await response.json()
+        assert data["search_path"] == default["search_path"]
+        assert data["users"] == 1
+        assert len(tenants) == 2
+
+
+async def test_circuit_breaker(app_circuit_breaker):
+    async with TestClient(TestServer(app_circuit_breaker)) as client:
+        breaker = app_circuit_breaker["gino_db"].bind.circuit_breaker
+        for _ in range(breaker.failure_threshold):
+            breaker.failure()
+        assert breaker.state == breaker.OPEN
+
+        response = await client.get("/users/1")
+        assert response.status == 503
+
+        await asyncio.sleep(breaker.recovery_timeout * 2)
+        assert breaker.state == breaker.CLOSED
+        response = await client.get("/users/1")
+        assert response.status == 404
+
+
+async def test_rows(app):
+    async with TestClient(TestServer(app)) as client:
+        for method in "012":
+            response = await client.get("/rows?method=" + method)
+            assert response.status == 200
+            assert await response.json() == []
+
+        response = await client.post("/users", data=dict(name="fantix"))
+        assert response.status == 200
+
+        for method in "012":
+            response = await client.get("/rows?method=" + method)
+            assert response.status == 200
+            assert await response.json() == [dict(id=1, name="fantix")]
+
+
+async def test_identity_map(app_identity_map):
+    async with TestClient(TestServer(app_identity_map)) as client:
+        for name in ("fantix", "tony"):
+            response = await client.post("/users", data=dict(name=name))
+            assert response.status == 200
+
+        response = await client.get("/identity/1")
+        assert response.status == 200
+        assert await response.json() == dict(same=True, size=2)
+
+
+async def test_hosts(app_hosts):
+    async with TestClient(TestServer(app_hosts)) as client:
+        monitor = app_hosts["gino_db"].bind.host_monitor
+        down, up = monitor.hosts
+        assert monitor.current == up
+        assert monitor.latency[down] is None
+        assert monitor.writable[up]
+
+        response = await client.get("/users/1")
+        assert response.status == 404
+
+        await asyncio.sleep(0.5)
+        assert monitor.current == up
+
+
+async def test_drain(app):
+    async with TestClient(TestServer(app)) as client:
+        engine = app["gino_db"].bind
+
+        async def work():
+            async with engine.acquire() as conn:
+                await conn.scalar("SELECT pg_sleep(10)")
+
+        task = asyncio.ensure_future(work())
+        await asyncio.sleep(0.5)
+        assert await engine.drain(0.1) == dict(released=0, cancelled=1, terminated=0)
+        with pytest.raises(asyncpg.QueryCanceledError):
+            await task
+
+        response = await client.get("/users/1")
+        assert response.status == 503
+
+
+async def test_write_behind(app):
+    db = app["gino_db"]
+    async with TestClient(TestServer(app)) as client:
+        for name in "abc":
+            response = await client.post("/users/later", data=dict(name=name))
+            assert response.status == 200
+        assert len(db.write_behind) == 6
+
+        await db.write_behind.flush()
+        assert len(db.write_behind) == 0
+        response = await client.get("/rows")
+        assert await response.json() == [
+            dict(id=1, name="a!"),
+            dict(id=2, name="b!"),
+            dict(id=3, name="c!"),
+        ]
+
+        response = await client.post("/users/later", data=dict(name="d"))
+        assert response.status == 200
+    assert len(db.write_behind) == 0
+
+
+async def test_connection_hooks(app_hooks, connected):
+    async with TestClient(TestServer(app_hooks)) as client:
+        for _ in range(20):
+            response = await client.get("/settings")
+            assert response.status == 200
+            data = await response.json()
+            assert data["application_name"] == "gino_aiohttp_test"
+            assert data["pid"] in connected
@@ -0,0 +1,42 @@
+import subprocess
+import sys
+
+import pytest
+
+# Cumulative import time budget of gino_aiohttp on top of gino, in microseconds
+IMPORT_TIME_BUDGET = 50000
+
+SCRIPT = """
+import sys
+import gino
+
+import gino_aiohttp
+
+assert "aiohttp.web" not in sys.modules, "aiohttp.web is imported eagerly"
+"""
+
+
+def _import_times(script):
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", script],
+        stderr=subprocess.PIPE,
+        check=True,
+        universal_newlines=True,
+    ).stderr
+    rv = {}
+    for line in out.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        try:
+            rv[name.strip()] = int(cumulative)
+        except ValueError:
+            pass
+    return rv
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason="-X importtime is 3.7+")
+def test_import_is_lazy():
+    times = _import_times(SCRIPT)
+    assert "gino_aiohttp" in times
+    assert times["gino_aiohttp"] < IMPORT_TIME_BUDGET, times["gino_aiohttp"]